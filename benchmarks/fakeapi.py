@@ -0,0 +1,226 @@
+import json
+import time
+import random
+import threading
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeTelegramServer:
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0,
+                 retry_after=1, global_rate=30, chat_rate=1, chat_burst=3, enforce_limits=True):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.enforce_limits = enforce_limits
+
+        self.sent = []
+        self.rate_limited = 0
+        # set by setWebhook, updates are posted there instead of getUpdates
+        self.webhook_url = None
+        self.webhook_retries = 0
+
+        self._condition = threading.Condition()
+        self._updates = []
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._chat_messages = defaultdict(list)
+        self._buckets = {}
+
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}/bot'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def push_update(self, **update):
+        with self._condition:
+            update['update_id'] = self._next_update_id
+            self._next_update_id += 1
+            if self.webhook_url is None:
+                self._updates.append(update)
+                self._condition.notify_all()
+                return
+
+        self._post_update(update)
+
+    def _post_update(self, update):
+        # like telegram, the update is posted again until the bot accepts it
+        data = json.dumps(update).encode('utf-8')
+        while True:
+            request = urllib.request.Request(self.webhook_url, data,
+                                             {'Content-Type': 'application/json'})
+            try:
+                urllib.request.urlopen(request).close()
+                return
+            except urllib.error.HTTPError as e:
+                if e.code != 503:
+                    raise
+                with self._condition:
+                    self.webhook_retries += 1
+                time.sleep(float(e.headers.get('Retry-After') or 1))
+
+    def messages_to(self, chat_id):
+        with self._condition:
+            return list(self._chat_messages[chat_id])
+
+    def wait_for_message(self, chat_id, count, timeout=30):
+        # waits until chat_id received more than count messages, returns the last one
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while len(self._chat_messages[chat_id]) <= count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f'no reply for chat {chat_id}')
+                self._condition.wait(remaining)
+
+            return self._chat_messages[chat_id][-1]
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                params = json.loads(body) if body else {}
+
+                status, payload = server._call(method, params)
+
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _call(self, method, params):
+        handler = getattr(self, f'_api_{method}', None)
+        if handler is None:
+            return 200, {'ok': True, 'result': True}
+
+        if method != 'getUpdates' and self.latency:
+            time.sleep(random.uniform(0, 2 * self.latency))
+
+        return handler(params)
+
+    def _too_many_requests(self, retry_after):
+        self.rate_limited += 1
+        return 429, {'ok': False, 'error_code': 429,
+                     'description': f'Too Many Requests: retry after {retry_after}',
+                     'parameters': {'retry_after': retry_after}}
+
+    def _take_token(self, key, rate, capacity, now):
+        tokens, updated = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        if tokens < 1:
+            return False
+
+        self._buckets[key] = (tokens - 1, now)
+        return True
+
+    def _check_limits(self, chat_id, now):
+        # returns retry_after when the request is rejected
+        if self.error_rate and random.random() < self.error_rate:
+            return self.retry_after
+
+        if not self.enforce_limits:
+            return None
+
+        if not self._take_token(None, self.global_rate, self.global_rate, now):
+            return self.retry_after
+        if not self._take_token(chat_id, self.chat_rate, self.chat_burst, now):
+            return self.retry_after
+
+        return None
+
+    def _message(self, chat_id, text, reply_markup=None):
+        with self._condition:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+
+        return {'message_id': message_id, 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': text,
+                'reply_markup': reply_markup}
+
+    def _api_getMe(self, params):
+        return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True,
+                                            'first_name': 'Fake', 'username': 'fake_bot'}}
+
+    def _api_getMyCommands(self, params):
+        return 200, {'ok': True, 'result': []}
+
+    def _api_setWebhook(self, params):
+        self.webhook_url = params.get('url') or None
+        return 200, {'ok': True, 'result': True}
+
+    def _api_getUpdates(self, params):
+        offset = int(params.get('offset') or 0)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+
+        with self._condition:
+            self._updates = [update for update in self._updates
+                             if update['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+
+            updates = self._updates[:int(params.get('limit') or 100)]
+
+        return 200, {'ok': True, 'result': updates}
+
+    def _api_sendMessage(self, params):
+        chat_id = int(params['chat_id'])
+        reply_markup = params.get('reply_markup')
+        if isinstance(reply_markup, str):
+            reply_markup = json.loads(reply_markup)
+
+        now = time.monotonic()
+        with self._condition:
+            retry_after = self._check_limits(chat_id, now)
+            if retry_after is not None:
+                return self._too_many_requests(retry_after)
+
+        message = self._message(chat_id, params.get('text'), reply_markup)
+
+        with self._condition:
+            self.sent.append((time.time(), chat_id, message))
+            self._chat_messages[chat_id].append(message)
+            self._condition.notify_all()
+
+        return 200, {'ok': True, 'result': message}
+
+    def _api_editMessageText(self, params):
+        message = self._message(int(params['chat_id']), params.get('text'))
+        message['message_id'] = int(params['message_id'])
+        return 200, {'ok': True, 'result': message}
+
+    def _api_answerCallbackQuery(self, params):
+        return 200, {'ok': True, 'result': True}
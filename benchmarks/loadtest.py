@@ -0,0 +1,197 @@
+import os
+import sys
+import time
+import shutil
+import socket
+import logging
+import argparse
+import datetime
+import tempfile
+import threading
+import statistics
+import warnings
+
+from telegramreminder import db
+from telegramreminder.bot import TelegramReminder
+from benchmarks.fakeapi import FakeTelegramServer
+
+
+class SimulatedUser:
+
+    def __init__(self, server, chat_id, think=0.5, timeout=30):
+        self.server = server
+        self.chat_id = chat_id
+        self.think = think
+        self.timeout = timeout
+        self.steps = []
+        self.error = None
+
+    def _user(self):
+        return {'id': self.chat_id, 'is_bot': False, 'first_name': f'user{self.chat_id}'}
+
+    def _chat(self):
+        return {'id': self.chat_id, 'type': 'private'}
+
+    def _send_text(self, text):
+        self.server.push_update(message={
+            'message_id': 0, 'date': int(time.time()), 'chat': self._chat(),
+            'from': self._user(), 'text': text})
+
+    def _press(self, message, data):
+        self.server.push_update(callback_query={
+            'id': str(self.chat_id), 'from': self._user(), 'chat_instance': str(self.chat_id),
+            'message': {'message_id': message['message_id'], 'date': message['date'],
+                        'chat': self._chat(), 'text': message['text']},
+            'data': data})
+
+    def _step(self, action):
+        time.sleep(self.think)
+        count = len(self.server.messages_to(self.chat_id))
+        start = time.perf_counter()
+        action()
+        message = self.server.wait_for_message(self.chat_id, count, self.timeout)
+        self.steps.append(time.perf_counter() - start)
+
+        return message
+
+    def create_reminder(self, fire_at):
+        # fire_at is the local time, the flow is the one of the "new reminder" button
+        try:
+            menu = {'message_id': 0, 'date': int(time.time()), 'text': 'Menu'}
+            self._step(lambda: self._press(menu, 'NEW_REMINDER;'))
+            calendar = self._step(lambda: self._send_text(f'load test {self.chat_id}'))
+            self._step(lambda: self._press(
+                calendar, f'DAY;{fire_at.year};{fire_at.month};{fire_at.day}'))
+            self._step(lambda: self._send_text(fire_at.strftime('%H:%M')))
+        except Exception as e:
+            self.error = e
+
+
+def percentile(samples, share):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * share))]
+
+
+def get_fire_time(lead):
+    # reminders have minute precision, every user gets the same minute
+    timezone = db.UserSettings.get_default_settings('timezone')
+    now = db.get_local_time(datetime.datetime.utcnow(), timezone)
+    fire_at = now + datetime.timedelta(seconds=lead + 60)
+    fire_at = fire_at.replace(second=0, microsecond=0)
+
+    return fire_at, db.get_utc_time(fire_at, timezone)
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run(args, workdir):
+    server = FakeTelegramServer(latency=args.latency, error_rate=args.error_rate,
+                                enforce_limits=not args.no_limits)
+    server.start()
+
+    bot = TelegramReminder('123456:LOADTEST', db_url=f'sqlite:///{os.path.join(workdir, "load")}.db',
+                           workers=args.workers, delivery_workers=args.delivery_workers,
+                           base_url=server.base_url)
+    if args.webhook:
+        port = get_free_port()
+        bot.run(webhook_url=f'http://127.0.0.1:{port}', listen='127.0.0.1', port=port,
+                handler_workers=args.handler_workers, queue_size=args.queue_size)
+    else:
+        bot.run()
+
+    try:
+        fire_at, fire_at_utc = get_fire_time(args.lead)
+        users = [SimulatedUser(server, 1000 + i, args.think, args.timeout)
+                 for i in range(args.users)]
+        threads = [threading.Thread(target=user.create_reminder, args=(fire_at,))
+                   for user in users]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        creation_time = time.perf_counter() - start
+
+        created = [user for user in users if user.error is None]
+        failed = [user for user in users if user.error is not None]
+        steps = [step for user in created for step in user.steps]
+
+        delivered = len(server.sent)
+        fire_at_timestamp = fire_at_utc.replace(tzinfo=datetime.timezone.utc).timestamp()
+        if time.time() > fire_at_timestamp:
+            print('Warning: reminders were created after the fire time, raise --lead')
+
+        # every created reminder adds one more message to its chat
+        expected = delivered + len(created)
+        deadline = fire_at_timestamp + args.timeout
+        while len(server.sent) < expected and time.time() < deadline:
+            time.sleep(0.1)
+
+        deliveries = [sent_at for sent_at, chat_id, message in server.sent[delivered:]]
+    finally:
+        bot.stop()
+        server.stop()
+
+    print(f'users                  {args.users}')
+    print(f'failed flows           {len(failed)}')
+    if steps:
+        print(f'creation steps/sec     {len(steps) / creation_time:.1f}')
+        print(f'step p50/p99 ms        {statistics.median(steps) * 1000:.1f}'
+              f' / {percentile(steps, 0.99) * 1000:.1f}')
+
+    print(f'delivered              {len(deliveries)} of {len(created)}')
+    if deliveries:
+        lags = [sent_at - fire_at_timestamp for sent_at in deliveries]
+        duration = max(deliveries) - min(deliveries)
+        if duration:
+            print(f'messages/sec           {len(deliveries) / duration:.1f}')
+        print(f'lag p50/p99/max s      {statistics.median(lags):.2f}'
+              f' / {percentile(lags, 0.99):.2f} / {max(lags):.2f}')
+
+    print(f'429 responses          {server.rate_limited}')
+    if args.webhook:
+        print(f'webhook 503 responses  {server.webhook_retries}')
+
+    return 0 if not failed and len(deliveries) == len(created) else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Load test of the whole bot against a fake Bot API server')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--lead', type=int, default=60,
+                        help='seconds between the start and the earliest fire time')
+    parser.add_argument('--think', type=float, default=0.5,
+                        help='seconds each user waits before the next step')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='mean Bot API latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of sendMessage calls answered with 429')
+    parser.add_argument('--no-limits', action='store_true',
+                        help='do not enforce the Telegram rate limits')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--delivery-workers', type=int, default=8)
+    parser.add_argument('--webhook', action='store_true',
+                        help='receive updates through a webhook instead of polling')
+    parser.add_argument('--handler-workers', type=int, default=8)
+    parser.add_argument('--queue-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+    logging.basicConfig(level=logging.ERROR)
+
+    workdir = tempfile.mkdtemp(prefix='telegramreminder-load-')
+    try:
+        return run(args, workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
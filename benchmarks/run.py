@@ -0,0 +1,223 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import tempfile
+import statistics
+import warnings
+
+from telegramreminder import db
+from telegramreminder import textparser
+from telegramreminder import telegramcalendar
+from telegramreminder.bot import TelegramReminder
+from telegramreminder.delivery import DeliveryPool
+
+
+class StubBot:
+
+    id = 0
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, **kwargs):
+        self.sent += 1
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def summarize(name, samples, ops):
+    samples = sorted(samples)
+    total = sum(samples)
+    return {
+        'name': name,
+        'ops_per_sec': ops / total if total else float('inf'),
+        'p50_ms': statistics.median(samples) * 1000,
+        'p99_ms': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+    }
+
+
+def measure(name, func, repeat, ops_per_call=1):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+
+    return summarize(name, samples, ops_per_call * repeat)
+
+
+def fill_reminders(engine, count, due, chats=1000):
+    now = datetime.datetime.utcnow()
+    delta = datetime.timedelta(hours=-1 if due else 1)
+
+    session = db.get_session(engine)
+    for start in range(0, count, 10000):
+        session.bulk_insert_mappings(db.Reminder, [
+            {'chat_id': i % chats, 'text': f'reminder {i}', 'datetime': now + delta,
+             'frequency': 'DAY' if i % 4 == 0 else None}
+            for i in range(start, min(start + 10000, count))])
+    session.commit()
+    session.close()
+
+
+def open_bot(workdir, name, batch_size=500):
+    bot = TelegramReminder('123456:BENCHMARK', db_url=f'sqlite:///{os.path.join(workdir, name)}.db',
+                           batch_size=batch_size)
+    bot.reminder_scheduler.stop()
+    # the stub bot is not rate limited
+    bot.delivery.shutdown()
+    bot.delivery = DeliveryPool(workers=8, global_rate=10 ** 9, chat_rate=10 ** 9)
+
+    return bot
+
+
+def bench_send_reminders(workdir, size):
+    bot = open_bot(workdir, f'send_{size}')
+    fill_reminders(bot.db_engine, size, due=True)
+
+    stub = StubBot()
+    samples = []
+    more = True
+    while more:
+        start = time.perf_counter()
+        more = bot._send_reminders(stub, None)
+        samples.append(time.perf_counter() - start)
+
+    bot.delivery.shutdown()
+    return summarize(f'send_reminders[{size}]', samples, stub.sent)
+
+
+def bench_get_reminders(workdir, size, repeat):
+    engine = db.open_database(f'sqlite:///{os.path.join(workdir, f"query_{size}")}.db')
+    fill_reminders(engine, size, due=False)
+    fill_reminders(engine, 500, due=True)
+
+    return [
+        measure(f'get_schedule[{size}]',
+                lambda: db.Reminder.get_schedule(engine, 500), repeat, 500),
+        measure(f'get_reminders[{size}]',
+                lambda: list(db.Reminder.get_reminders(engine)), max(1, repeat // 10), 500),
+        measure(f'get_chat_reminders[{size}]',
+                lambda: db.Reminder.get_chat_reminders(engine, 1), repeat),
+    ]
+
+
+def bench_set_user_input(workdir, repeat):
+    engine = db.open_database(f'sqlite:///{os.path.join(workdir, "input")}.db')
+    tomorrow = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+    date = datetime.datetime(tomorrow.year, tomorrow.month, tomorrow.day)
+
+    steps = {'title': [], 'date': [], 'time': [], 'text': []}
+    for chat_id in range(repeat):
+        for step, input_data in (('title', 'Buy milk'), ('date', date), ('time', '10:30'),
+                                 ('text', 'Buy bread tomorrow at 10')):
+            start = time.perf_counter()
+            db.UserInput.set_user_input(engine, chat_id, input_data)
+            steps[step].append(time.perf_counter() - start)
+
+    return [summarize(f'set_user_input[{step}]', samples, len(samples))
+            for step, samples in steps.items()]
+
+
+def bench_parser(repeat):
+    now = datetime.datetime.utcnow()
+    texts = ('Купить хлеб завтра в 10 30 ежедневно', 'Позвонить маме во вторник в 9:15',
+             'call mom on friday at 18:30 weekly', 'no date or time here')
+
+    return [
+        measure('parse_reminder',
+                lambda: [textparser.parse_reminder(text, now) for text in texts],
+                repeat, len(texts)),
+        measure('get_reminder_data_by_str',
+                lambda: db.UserInput.get_reminder_data_by_str(texts[0], 'Etc/GMT-5'),
+                repeat),
+    ]
+
+
+def bench_calendar(repeat):
+    now = datetime.datetime.now()
+    return [
+        measure('create_calendar[current]',
+                lambda: telegramcalendar.create_calendar('ENG'), repeat),
+        measure('create_calendar[next]',
+                lambda: telegramcalendar.create_calendar('RUS', now.year + 1, now.month), repeat),
+    ]
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for result in results:
+        previous = baseline.get(result['name'])
+        if previous is None:
+            result['change'] = None
+            continue
+
+        result['change'] = result['ops_per_sec'] / previous['ops_per_sec'] - 1
+        if result['change'] < -tolerance:
+            regressions.append(result['name'])
+
+    return regressions
+
+
+def report(results):
+    print(f'{"benchmark":<36}{"ops/sec":>14}{"p50 ms":>11}{"p99 ms":>11}{"vs base":>10}')
+    for result in results:
+        change = result.get('change')
+        change = '' if change is None else f'{change:+.0%}'
+        print(f'{result["name"]:<36}{result["ops_per_sec"]:>14.1f}'
+              f'{result["p50_ms"]:>11.3f}{result["p99_ms"]:>11.3f}{change:>10}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for the reminder hot paths')
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='comma separated row counts, up to 1000000')
+    parser.add_argument('--repeat', type=int, default=200)
+    # ops/sec depend on the machine, a baseline is only comparable on the one it was saved on
+    parser.add_argument('--baseline', help='compare against results saved with --save-baseline')
+    parser.add_argument('--save-baseline', metavar='PATH', help='save the results as a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed ops/sec drop against the baseline')
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    workdir = tempfile.mkdtemp(prefix='telegramreminder-bench-')
+    try:
+        results = []
+        for size in sizes:
+            results.append(bench_send_reminders(workdir, size))
+            results.extend(bench_get_reminders(workdir, size, args.repeat))
+        results.extend(bench_set_user_input(workdir, args.repeat))
+        results.extend(bench_parser(args.repeat))
+        results.extend(bench_calendar(args.repeat))
+    finally:
+        shutil.rmtree(workdir)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = compare(results, baseline, args.tolerance)
+    report(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({result['name']: result for result in results}, f, indent=2)
+
+    if regressions:
+        print('Regressions: ' + ', '.join(regressions))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
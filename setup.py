@@ -23,8 +23,11 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     install_requires=requirements(),
     url="https://github.com/BrandesDenis/telegramreminder",
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(exclude=["benchmarks"]),
     package_data={'telegramreminder': ['translations.ini']},
+    entry_points={
+        'console_scripts': ['telegramreminder-transfer=telegramreminder.transfer:main'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -0,0 +1,78 @@
+import asyncio
+import inspect
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from . import db
+
+
+class AsyncDatabase:
+
+    def __init__(self, engine, workers=8):
+        self.engine = engine
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='db')
+
+        self.UserInput = AsyncModel(self, db.UserInput, (
+            'clear_user_input', 'set_user_input'), (
+            'parse_reminder_str', 'get_reminder_data_by_str'))
+        self.Reminder = AsyncModel(self, db.Reminder, (
+            'get_reminders', 'get_chat_reminders', 'get_reminder', 'get_schedule', 'get_earliest',
+            'delete_reminder', 'move_reccuring_reminder'), (
+            'get_next_datetime', 'get_occurrences'))
+        self.Delivery = AsyncModel(self, db.Delivery, (
+            'stage_due_reminders', 'claim_pending', 'record_results', 'release',
+            'get_next_attempt', 'prune', 'get_text'), (
+            'get_key',))
+        self.UserSettings = AsyncModel(self, db.UserSettings, (
+            'set_user_settings', 'get_user_settings'), (
+            'get_default_settings',))
+
+    @classmethod
+    def open(cls, db_url, workers=8, **kwargs):
+        engine = db.open_database(db_url, pool_size=workers, **kwargs)
+        return cls(engine, workers)
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs))
+
+    def close(self):
+        self._executor.shutdown()
+        self.engine.dispose()
+
+
+class AsyncModel:
+
+    def __init__(self, database, model, methods, helpers=()):
+        self._model = model
+        # helpers that do not use the database stay synchronous
+        self._helpers = frozenset(helpers)
+
+        for name in methods:
+            setattr(self, name, self._wrap(database, getattr(model, name)))
+
+    def __getattr__(self, name):
+        # anything else would be a blocking call without the engine
+        if name in self.__dict__.get('_helpers', ()):
+            return getattr(self._model, name)
+
+        raise AttributeError(f'{self._model.__name__}.{name} is not available in AsyncDatabase')
+
+    @staticmethod
+    def _wrap(database, method):
+        if inspect.isgeneratorfunction(method):
+            func = functools.wraps(method)(lambda *args, **kwargs: list(method(*args, **kwargs)))
+        else:
+            func = method
+
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            return await database.run(func, database.engine, *args, **kwargs)
+
+        return wrapper
+
+
+async def deliver(pool, bot, messages):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, pool.deliver, bot, messages)
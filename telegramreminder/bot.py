@@ -1,100 +1,146 @@
-import pytz
+import os
+import socket
+import datetime
+import threading
 from . import db
+from . import delivery
+from . import metrics
+from . import keyboards
+from . import recurrence
+from . import webhook
 from . import telegramcalendar
+from .scheduler import ReminderScheduler
 from .language import translate
 from telegram import ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Updater, CallbackQueryHandler, MessageHandler, Filters, RegexHandler, CommandHandler
+from collections import OrderedDict
+
+
+# limits of one digest message
+DIGEST_MAX_ITEMS = 20
+DIGEST_MAX_LENGTH = 4000
 
 
 class TelegramReminder:
 
-    def __init__(self, token, db_url='sqlite:///BASE.db', interval=5):
+    def __init__(self, token, db_url='sqlite:///BASE.db', interval=300, batch_size=500,
+                 workers=4, delivery_workers=8, retry_delay=30,
+                 catch_up=db.CATCH_UP_ONCE, catch_up_grace=60, debug=False,
+                 worker_id=None, lease=300, shard_count=None, shard_index=None,
+                 list_page_size=10, base_url=None, metrics_port=None, durable_input=False,
+                 max_attempts=5, outbox_retention=86400, digest_threshold=None):
         self._token = token
         self._interval = interval
-
-        self._set_db_engine(db_url)
-
-        self.updater = Updater(token=token)
+        self._batch_size = batch_size
+        self._retry_delay = datetime.timedelta(seconds=retry_delay)
+        self._catch_up = catch_up
+        self._catch_up_grace = datetime.timedelta(seconds=catch_up_grace)
+        self._worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+        self._lease = lease
+        self._shard_count = shard_count
+        self._shard_index = shard_index
+        self._list_page_size = list_page_size
+        self._max_attempts = max_attempts
+        self._outbox_retention = datetime.timedelta(seconds=outbox_retention)
+        self._pruned_at = None
+        self._digest_threshold = digest_threshold
+        self.webhook_server = None
+        self.update_queue = None
+
+        self._set_db_engine(db_url, debug)
+        if durable_input:
+            db.set_input_store(self.db_engine, db.DatabaseInputStore(self.db_engine))
+
+        self.delivery = delivery.DeliveryPool(workers=delivery_workers)
+
+        # every delivery worker holds its own connection to the Bot API
+        request_kwargs = {'con_pool_size': workers + 4 + delivery_workers}
+        self.updater = Updater(token=token, base_url=base_url, workers=workers,
+                               request_kwargs=request_kwargs)
         self.dispatcher = self.updater.dispatcher
 
         self.scheduler = self.updater.job_queue
-        self.scheduler.run_repeating(
-            self._send_reminders, interval=self._interval)
+        self.reminder_scheduler = ReminderScheduler(
+            self.db_engine, self.scheduler, self._send_reminders, resync_interval=self._interval,
+            shard_count=self._shard_count, shard_index=self._shard_index)
+        self.reminder_scheduler.start()
+        # deliveries left in the outbox by a stopped process are sent right away
+        self.reminder_scheduler.wake_at(datetime.datetime.utcnow())
 
         self._add_handlers()
+        keyboards.preload()
 
-    def _set_db_engine(self, db_url):
-        self.db_engine = db.open_database(db_url)
+        metrics.registry.watch_cache('settings', db.settings_cache)
+        metrics.registry.watch_cache('timezone', db.get_timezone)
+        metrics.registry.watch_cache('calendar', telegramcalendar.build_calendar)
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = metrics.serve(metrics_port)
+
+    def _set_db_engine(self, db_url, debug=False):
+        self.db_engine = db.open_database(db_url, echo=debug)
+        metrics.instrument_engine(self.db_engine)
 
     def _add_handlers(self):
         start = CommandHandler('start', self._start)
-        self.dispatcher.add_handler(start)
+        self._add_handler(start, '/start')
 
         menu = RegexHandler(r'^\s*(?:Меню|Menu)\s*', self._menu)
-        self.dispatcher.add_handler(menu)
+        self._add_handler(menu, 'menu')
 
         cancel = CallbackQueryHandler(self._cancel,
                                       pattern=r'^CANCEL;')
-        self.dispatcher.add_handler(cancel)
+        self._add_handler(cancel, 'CANCEL')
 
         settings = CallbackQueryHandler(self._settings,
                                         pattern=r'^GETSETTINGS;')
-        self.dispatcher.add_handler(settings)
+        self._add_handler(settings, 'GETSETTINGS')
 
         settings_action = CallbackQueryHandler(self._settings_action,
                                                pattern=r'^SETTINGS;.*')
-        self.dispatcher.add_handler(settings_action)
+        self._add_handler(settings_action, 'SETTINGS')
 
         new_reminder_action = CallbackQueryHandler(self._new_reminder_action,
                                                    pattern=r'^NEW_REMINDER;.*')
-        self.dispatcher.add_handler(new_reminder_action)
+        self._add_handler(new_reminder_action, 'NEW_REMINDER')
 
         reminders_list = CallbackQueryHandler(self._reminders_list,
                                               pattern=r'^REMINDER_LIST;')
-        self.dispatcher.add_handler(reminders_list)
+        self._add_handler(reminders_list, 'REMINDER_LIST')
 
         recurring_action = CallbackQueryHandler(self._recurring_action,
                                                 pattern=r'^RECCURING;.*')
-        self.dispatcher.add_handler(recurring_action)
+        self._add_handler(recurring_action, 'RECCURING')
 
         reminder_actions = CallbackQueryHandler(self._reminder_actions,
                                                 pattern=r'^REMINDER;.*')
-        self.dispatcher.add_handler(reminder_actions)
+        self._add_handler(reminder_actions, 'REMINDER')
 
         calendar_pattern = r'^(?:IGNORE|DAY|PREV|NEXT).*'
         calendar_actions = CallbackQueryHandler(self._calendar_actions,
                                                 pattern=calendar_pattern)
-        self.dispatcher.add_handler(calendar_actions)
+        self._add_handler(calendar_actions, 'calendar')
 
         move_reminder = CallbackQueryHandler(self._move_reminder,
                                              pattern=r'^MOVE;.*')
-        self.dispatcher.add_handler(move_reminder)
+        self._add_handler(move_reminder, 'MOVE')
 
         del_reminder = CallbackQueryHandler(self._del_reminder,
                                             pattern=r'^DEL;.*')
-        self.dispatcher.add_handler(del_reminder)
+        self._add_handler(del_reminder, 'DEL')
 
         process_message = MessageHandler(Filters.text, self._process_message)
-        self.dispatcher.add_handler(process_message)
+        self._add_handler(process_message, 'message')
+
+    def _add_handler(self, handler, name):
+        handler.callback = metrics.timed_handler(name, handler.callback)
+        self.dispatcher.add_handler(handler)
 
     def _get_default_keyboard(self, chat_id):
         lang = db.UserSettings.get_user_settings(
             self.db_engine, chat_id, 'language')
 
-        button_new_reminder = InlineKeyboardButton(
-            translate('newReminder', lang) + ' 🕭', callback_data='NEW_REMINDER;')
-        button_new_recc_reminder = InlineKeyboardButton(
-            translate('newRecReminder', lang) + ' ♲', callback_data='NEW_REMINDER;RECC')
-        button_reminders_list = InlineKeyboardButton(
-            translate('remindersList', lang) + ' 🗓', callback_data='REMINDER_LIST;')
-
-        reply_markup = InlineKeyboardMarkup([
-            [button_new_reminder],
-            [button_new_recc_reminder],
-            [button_reminders_list],
-        ])
-
-        return reply_markup
+        return keyboards.main_menu(lang)
 
     @staticmethod
     def _get_callback_data(data_str):
@@ -108,11 +154,7 @@ class TelegramReminder:
             self.db_engine, chat_id, 'language')
 
         text = translate('hello', lang)
-        reply_markup = self._get_default_keyboard(chat_id)
-
-        button_settings = InlineKeyboardButton(
-            translate('settings', lang) + ' ⛭', callback_data='GETSETTINGS;')
-        reply_markup.inline_keyboard.append([button_settings])
+        reply_markup = keyboards.start_menu(lang)
 
         bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
 
@@ -121,15 +163,7 @@ class TelegramReminder:
         lang = db.UserSettings.get_user_settings(
             self.db_engine, chat_id, 'language')
 
-        button_language = InlineKeyboardButton(
-            translate('lang', lang), callback_data='SETTINGS;LANG')
-        button_timezone = InlineKeyboardButton(
-            translate('timezone', lang), callback_data='SETTINGS;TIMEZONE')
-
-        reply_markup = InlineKeyboardMarkup([
-            [button_language],
-            [button_timezone],
-        ])
+        reply_markup = keyboards.settings_menu(lang)
 
         text = translate('settings', lang)
         bot.answer_callback_query(callback_query_id=update.callback_query.id)
@@ -146,27 +180,10 @@ class TelegramReminder:
         if len(reminder_data) == 1:
             if settings_name == 'LANG':
                 text = translate('chooseLang', lang)
-                button_eng = InlineKeyboardButton(
-                    'ENG', callback_data='SETTINGS;LANG;ENG')
-                button_rus = InlineKeyboardButton(
-                    'RUS', callback_data='SETTINGS;LANG;RUS')
-                keyboard = [[button_eng], [button_rus]]
+                reply_markup = keyboards.language_menu()
             elif settings_name == 'TIMEZONE':
                 text = translate('chooseTimezone', lang)
-                keyboard = []
-                row = []
-                timezones = [
-                    tz for tz in pytz.all_timezones if 'Etc/GMT' in tz]
-                for i, timezine in enumerate(timezones):
-                    if i % 3 == 0:
-                        keyboard.append(row)
-                        row = []
-                    button = InlineKeyboardButton(timezine.replace('Etc/', ''),
-                                                  callback_data='SETTINGS;TIMEZONE;' + timezine)
-                    row.append(button)
-                keyboard.append(row)
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
+                reply_markup = keyboards.timezone_menu()
 
         else:
             settings_value = reminder_data[1]
@@ -195,19 +212,7 @@ class TelegramReminder:
             update.callback_query.data)
 
         if reminder_data[0] == 'RECC':
-            button_day = InlineKeyboardButton(
-                translate('recDay', lang), callback_data='RECCURING;DAY')
-            button_week = InlineKeyboardButton(
-                translate('recWeek', lang), callback_data='RECCURING;WEEK')
-            button_month = InlineKeyboardButton(
-                translate('recMonth', lang), callback_data='RECCURING;MONTH')
-            button_workdays = InlineKeyboardButton(
-                translate('recWork', lang), callback_data='RECCURING;WORKDAYS')
-            button_weekends = InlineKeyboardButton(
-                translate('recWeekEnds', lang), callback_data='RECCURING;WEEKENDS')
-
-            reply_markup = InlineKeyboardMarkup(
-                [[button_day], [button_week], [button_month], [button_workdays], [button_weekends]])
+            reply_markup = keyboards.recurrence_menu(lang)
             reply_text = translate('chooseRec', lang)
         else:
             reply_markup = None
@@ -222,6 +227,9 @@ class TelegramReminder:
         lang=db.UserSettings.get_user_settings(
             self.db_engine, chat_id, 'language')
         recurring_data=update.callback_query.data.replace('RECCURING;', '')
+        if not recurrence.is_valid(recurring_data):
+            bot.answer_callback_query(callback_query_id = update.callback_query.id)
+            return
 
         db.UserInput.set_user_input(
             self.db_engine, chat_id, recurring_data, frequency = True)
@@ -233,11 +241,29 @@ class TelegramReminder:
         chat_id=update.callback_query.from_user.id
         lang=db.UserSettings.get_user_settings(
             self.db_engine, chat_id, 'language')
+        list_data=TelegramReminder._get_callback_data(
+            update.callback_query.data)
+
+        after = before = None
+        if len(list_data) == 3:
+            key = (datetime.datetime.strptime(list_data[1], '%Y%m%d%H%M%S%f'),
+                   int(list_data[2]))
+            if list_data[0] == 'NEXT':
+                after = key
+            else:
+                before = key
+
+        reminders, has_prev, has_next = db.Reminder.get_chat_reminders(
+            self.db_engine, chat_id, self._list_page_size, after, before)
+        if not reminders and (after is not None or before is not None):
+            # the page was emptied in the meantime, start over
+            reminders, has_prev, has_next = db.Reminder.get_chat_reminders(
+                self.db_engine, chat_id, self._list_page_size)
 
         keyboard=[]
-        for reminder in db.Reminder.get_reminders(self.db_engine, False):
-            freq_str='' if reminder.frequency is None else f'({translate(reminder.frequency, lang)})'
-            time_str=reminder.datetime.strftime('%d.%m.%y %H:%M')
+        for reminder in reminders:
+            freq_str='' if reminder.frequency is None else f'({recurrence.describe(reminder.frequency, lang)})'
+            time_str=reminder.local_datetime.strftime('%d.%m.%y %H:%M')
 
             button_text=f'{reminder.text} {time_str} {freq_str}'
             callback_data=f'REMINDER;{reminder.id}'
@@ -245,6 +271,30 @@ class TelegramReminder:
             button=InlineKeyboardButton(
                 button_text, callback_data = callback_data)
             keyboard.append([button])
+
+        row = []
+        if has_prev:
+            first = reminders[0]
+            callback_data = f'REMINDER_LIST;PREV;{first.datetime:%Y%m%d%H%M%S%f};{first.id}'
+            row.append(InlineKeyboardButton('<', callback_data=callback_data))
+        if has_next:
+            last = reminders[-1]
+            callback_data = f'REMINDER_LIST;NEXT;{last.datetime:%Y%m%d%H%M%S%f};{last.id}'
+            row.append(InlineKeyboardButton('>', callback_data=callback_data))
+        if row:
+            keyboard.append(row)
+
+        bot.answer_callback_query(callback_query_id = update.callback_query.id)
+
+        if after is not None or before is not None:
+            # paging replaces the list in the same message
+            query = update.callback_query
+            bot.edit_message_text(text=query.message.text,
+                                  chat_id=query.message.chat_id,
+                                  message_id=query.message.message_id,
+                                  reply_markup=InlineKeyboardMarkup(keyboard))
+            return
+
         if len(keyboard):
             reply_markup=InlineKeyboardMarkup(keyboard)
             reply_text=translate('remindersList', lang)
@@ -252,7 +302,6 @@ class TelegramReminder:
             reply_text=translate('remindersListEmpty', lang)
             reply_markup=self._get_default_keyboard(chat_id)
 
-        bot.answer_callback_query(callback_query_id = update.callback_query.id)
         bot.send_message(chat_id = chat_id, text = reply_text,
                          reply_markup = reply_markup)
 
@@ -312,9 +361,7 @@ class TelegramReminder:
             reply_markup=telegramcalendar.create_calendar(lang = lang)
         elif status == 1:
             reply_text=translate('setTime', lang)
-            cancel=InlineKeyboardButton(
-                translate('cancel', lang), callback_data = 'CANCEL;')
-            reply_markup=InlineKeyboardMarkup([[cancel]])
+            reply_markup=keyboards.cancel_menu(lang)
         elif status == 2:
             reply_text=translate('remSaved', lang)
             reply_markup=self._get_default_keyboard(chat_id)
@@ -345,6 +392,10 @@ class TelegramReminder:
         reminder_id=int(reminder_data[0])
         reccuring=reminder_data[1]
         reminder_text=update.effective_message.text
+        if len(reminder_data) > 2:
+            # an item of a digest, the message holds all of them
+            reminder_text=db.Delivery.get_text(
+                self.db_engine, int(reminder_data[2]), chat_id) or reminder_text
 
         db.UserInput.clear_user_input(self.db_engine, chat_id)
         if reccuring == '0':
@@ -366,24 +417,149 @@ class TelegramReminder:
                          reply_markup = reply_markup)
 
     def _send_reminders(self, bot, update):
-        for reminder in db.Reminder.get_reminders(self.db_engine):
-            reccuring=reminder.frequency is not None
-
-            lang=db.UserSettings.get_user_settings(
-                self.db_engine, reminder.chat_id, 'language')
-            callback_data = f'MOVE;{reminder.id};{int(reccuring)}'
-            button = InlineKeyboardButton(
-                translate('postpone', lang), callback_data=callback_data)
-            reply_markup = InlineKeyboardMarkup([[button]])
-
-            bot.send_message(chat_id=reminder.chat_id,
-                             text=reminder.text, reply_markup=reply_markup)
-
-            if reccuring:
-                db.Reminder.move_reccuring_reminder(
-                    self.db_engine, reminder.id)
+        with metrics.send_tick_seconds.time(), metrics.track('send_reminders'):
+            return self._send_due_reminders(bot)
+
+    def _send_due_reminders(self, bot):
+        # due reminders go to the outbox first, then the outbox is drained
+        staged = db.Delivery.stage_due_reminders(
+            self.db_engine, self._batch_size, self._catch_up, self._catch_up_grace,
+            self._shard_count, self._shard_index)
+        # a chat gets no more than can be sent in half of the lease, so the lease
+        # does not expire while sending; the rest waits for the next tick
+        quota = self.delivery.get_chat_quota(self._lease / 2)
+        per_chat = quota
+        if self._digest_threshold:
+            per_chat *= DIGEST_MAX_ITEMS
+        deliveries = db.Delivery.claim_pending(
+            self.db_engine, self._worker_id, self._batch_size, self._lease,
+            self._shard_count, self._shard_index, per_chat)
+        metrics.send_batch_size.observe(len(deliveries))
+
+        chats = OrderedDict()
+        for pending in deliveries:
+            chats.setdefault(pending.chat_id, []).append(pending)
+
+        messages = []
+        released = set()
+        for chat_deliveries in chats.values():
+            if self._digest_threshold and len(chat_deliveries) >= self._digest_threshold:
+                chat_messages = list(TelegramReminder._get_digests(chat_deliveries))
             else:
-                db.Reminder.delete_reminder(self.db_engine, reminder.id)
+                chat_messages = [TelegramReminder._get_message(pending)
+                                 for pending in chat_deliveries]
+            # the claim only holds more for digests, what does not fit the quota
+            # is given back
+            messages.extend(chat_messages[:quota])
+            released.update(delivery_id for message in chat_messages[quota:]
+                            for delivery_id in message.key)
+        if released:
+            db.Delivery.release(self.db_engine, released, self._worker_id)
+
+        results = self.delivery.deliver(bot, messages)
+        # a digest is sent or failed as a whole
+        statuses = {delivery_id: results[message.key]
+                    for message in messages for delivery_id in message.key}
+
+        attempted = [pending for pending in deliveries if pending.id not in released]
+        db.Delivery.record_results(
+            self.db_engine, attempted, statuses, self._worker_id,
+            self._max_attempts, self._retry_delay.total_seconds())
+        # retries and leases of crashed workers are kept in the outbox only
+        next_attempt = db.Delivery.get_next_attempt(
+            self.db_engine, self._shard_count, self._shard_index)
+        if next_attempt is not None:
+            self.reminder_scheduler.wake_at(next_attempt)
+
+        now = datetime.datetime.utcnow()
+        if self._pruned_at is None or now - self._pruned_at > self._outbox_retention / 24:
+            db.Delivery.prune(self.db_engine, now - self._outbox_retention)
+            self._pruned_at = now
+
+        # a full batch or a full chat means more reminders may already be due
+        return (staged == self._batch_size or len(deliveries) == self._batch_size or bool(released)
+                or any(len(chat_deliveries) >= per_chat for chat_deliveries in chats.values()))
 
-    def run(self):
-        self.updater.start_polling()
+    @staticmethod
+    def _get_message(pending):
+        reccuring=pending.frequency is not None
+
+        callback_data = f'MOVE;{pending.reminder_id};{int(reccuring)}'
+        button = InlineKeyboardButton(
+            translate('postpone', pending.language), callback_data=callback_data)
+        reply_markup = InlineKeyboardMarkup([[button]])
+
+        return delivery.Message(
+            (pending.id,), pending.chat_id, pending.text, reply_markup, pending.due)
+
+    @staticmethod
+    def _get_digests(deliveries):
+        # one message with a numbered line and a postpone button per reminder,
+        # the delivery id in the button points to the reminder text
+        chunks = [[]]
+        length = 0
+        for pending in deliveries:
+            line_length = len(pending.text) + 5
+            if chunks[-1] and (len(chunks[-1]) == DIGEST_MAX_ITEMS
+                               or length + line_length > DIGEST_MAX_LENGTH):
+                chunks.append([])
+                length = 0
+            chunks[-1].append(pending)
+            length += line_length
+
+        for chunk in chunks:
+            lines = []
+            buttons = []
+            for number, pending in enumerate(chunk, 1):
+                reccuring=pending.frequency is not None
+                lines.append(f'{number}. {pending.text}')
+
+                callback_data = f'MOVE;{pending.reminder_id};{int(reccuring)};{pending.id}'
+                buttons.append(InlineKeyboardButton(
+                    f'{translate("postpone", pending.language)} {number}',
+                    callback_data=callback_data))
+
+            reply_markup = InlineKeyboardMarkup(
+                [buttons[i:i + 2] for i in range(0, len(buttons), 2)])
+
+            yield delivery.Message(
+                tuple(item.id for item in chunk), chunk[0].chat_id,
+                '\n'.join(lines), reply_markup, min(item.due for item in chunk))
+
+    def run(self, webhook_url=None, listen='0.0.0.0', port=8443, url_path=None,
+            handler_workers=8, queue_size=1000):
+        if webhook_url is None:
+            self.updater.start_polling()
+            return
+
+        # webhook_url is the public address of a proxy that terminates TLS
+        # and forwards to listen:port
+        url_path = url_path or f'/{self._token}'
+
+        self.update_queue = webhook.UpdateQueue(self.dispatcher, handler_workers, queue_size)
+        self.update_queue.start()
+        self.webhook_server = webhook.WebhookServer(
+            self.updater.bot, self.update_queue, listen, port, url_path)
+        self.webhook_server.start()
+        self.scheduler.start()
+
+        self.updater.bot.set_webhook(url=webhook_url.rstrip('/') + url_path)
+
+    def stop(self):
+        if self.webhook_server is not None:
+            self.webhook_server.stop()
+            self.update_queue.stop()
+            self.scheduler.stop()
+        else:
+            self.updater.stop()
+        self.delivery.shutdown()
+
+    def run_worker(self, probe_interval=5):
+        # delivery only, several workers can share the database with one polling instance;
+        # reminders created by the polling instance are found by probing the database
+        self.reminder_scheduler.set_probe_interval(probe_interval)
+        self.scheduler.start()
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            self.scheduler.stop()
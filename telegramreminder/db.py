@@ -1,14 +1,49 @@
+import re
 import pytz
+import time
 import datetime
+import functools
+import threading
+from collections import OrderedDict, namedtuple
 from dateutil.relativedelta import relativedelta
-from sqlalchemy import create_engine
-from sqlalchemy import Column, Integer, String, Date, DateTime
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy import Column, Index, Integer, String, Date, DateTime
+from sqlalchemy import and_, or_, bindparam, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from . import textparser
+from . import recurrence
 
 
 Base = declarative_base()
 
+reminder_listeners = []
+
+UTC_NAME_RE = re.compile(r'^(?:Etc/)?(?:UTC|UCT|GMT|Zulu|Universal|Greenwich)(?:[+-]?0)?$', re.I)
+GMT_OFFSET_RE = re.compile(r'^Etc/GMT([+-])(\d{1,2})$', re.I)
+
+session_factories = {}
+
+CATCH_UP_ONCE = 'ONCE'
+CATCH_UP_ALL = 'ALL'
+CATCH_UP_SKIP = 'SKIP'
+
+DueReminder = namedtuple(
+    'DueReminder', 'id chat_id text datetime frequency language timezone')
+ChatReminder = namedtuple(
+    'ChatReminder', 'id text datetime frequency local_datetime')
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+PendingDelivery = namedtuple(
+    'PendingDelivery', 'id reminder_id chat_id text frequency language due attempts')
+
+DELIVERY_PENDING = 'PENDING'
+DELIVERY_SENT = 'SENT'
+DELIVERY_REJECTED = 'REJECTED'
+DELIVERY_FAILED = 'FAILED'
+
 
 class UserInput(Base):
 
@@ -29,93 +64,64 @@ class UserInput(Base):
 
     @staticmethod
     def clear_user_input(engine, chat_id):
-        session = get_session(engine)
-        session.query(UserInput).filter_by(chat_id=chat_id).delete()
-        session_commit(session)
+        get_input_store(engine).delete(chat_id)
 
     @staticmethod
     def set_user_input(engine, chat_id, input_data, frequency=False):
+        store = get_input_store(engine)
 
         if frequency:
-            UserInput.clear_user_input(engine, chat_id)
-
-        session = get_session(engine)
-        if frequency:
-            user_input = UserInput(chat_id=chat_id, frequency=input_data)
-            session.add(user_input)
-            session_commit(session)
+            store.set(chat_id, UserInput(chat_id=chat_id, frequency=input_data))
 
             return -1
 
-        user_input = session.query(UserInput).filter_by(
-            chat_id=chat_id).first()
+        user_input = store.get(chat_id)
         if user_input is None:
-
-            # пока что кастыль для испытания новой фичи, потом все нужно будет перерефачить
-            try:
+            if isinstance(input_data, str):
                 timezone = UserSettings.get_user_settings(
                     engine, chat_id, 'timezone')
-                date, scheduled, text = UserInput.get_reminder_data_by_str(
-                    input_data, timezone)
-                if timezone is not None:
-                    date = get_utc_time(date, timezone)
+                language = UserSettings.get_user_settings(
+                    engine, chat_id, 'language')
+                result = UserInput.parse_reminder_str(
+                    input_data, timezone, language)
 
-                if date <= datetime.datetime.utcnow():
-                    raise ValueError
+                if result.error is None:
+                    date = get_utc_time(result.date, timezone)
+                    if date > datetime.datetime.utcnow():
+                        reminder = Reminder(chat_id=chat_id, text=result.text,
+                                            datetime=date, frequency=result.frequency)
 
-                reminder = Reminder(chat_id=chat_id, text=text,
-                                    datetime=date, frequency=scheduled)
+                        save_reminder(engine, get_session(engine), reminder)
 
-                session.add(reminder)
-
-                session_commit(session)
-
-                return 2
-            except:
-                pass
+                        return 2
 
             user_input = UserInput(chat_id=chat_id)
-            session.add(user_input)
 
         if user_input.text is None:
             user_input.text = input_data
             state = 0
         elif user_input.date is None:
-            res_date = None
-
+            state = 0
             timezone = UserSettings.get_user_settings(
                 engine, chat_id, 'timezone')
 
             if isinstance(input_data, str):
-                try:
-                    date, _, _ = UserInput.get_reminder_data_by_str(
-                        input_data, timezone, only_datetime=True)
-
-                    if timezone is not None:
-                        date = get_utc_time(date, timezone)
-
-                    if date <= datetime.datetime.utcnow():
-                        raise ValueError
-
-                    reminder = Reminder(chat_id=chat_id, text=user_input.text,
-                                        datetime=date, frequency=user_input.frequency)
-
-                    session.add(reminder)
-
-                    session_commit(session)
-
-                    return 2
-
-                except:
-                    pass
-
-            res_date = process_date(input_data, timezone)
-
-            if res_date is not None:
-                user_input.date = res_date
-                state = 1
-            else:
-                state = 0
+                language = UserSettings.get_user_settings(
+                    engine, chat_id, 'language')
+                result = UserInput.parse_reminder_str(
+                    input_data, timezone, language, only_datetime=True)
+
+                if result.error is None:
+                    date = get_utc_time(result.date, timezone)
+                    if date > datetime.datetime.utcnow():
+                        state = 2
+
+            if state == 0:
+                res_date = process_date(input_data, timezone)
+
+                if res_date is not None:
+                    user_input.date = res_date
+                    state = 1
         else:
             state = 1
             res_time = process_time(input_data)
@@ -129,15 +135,17 @@ class UserInput(Base):
 
                 if date > datetime.datetime.utcnow():
                     state = 2
-                    session.delete(user_input)
 
         if state == 2:
             reminder = Reminder(chat_id=chat_id, text=user_input.text,
                                 datetime=date, frequency=user_input.frequency)
 
-            session.add(reminder)
-
-        session_commit(session)
+            # the reminder and the end of the conversation are committed together
+            session = get_session(engine)
+            store.delete(chat_id, session)
+            save_reminder(engine, session, reminder)
+        else:
+            store.set(chat_id, user_input)
 
         return state
 
@@ -146,224 +154,450 @@ class UserInput(Base):
         pass
 
     @staticmethod
-    def get_reminder_data_by_str(text, timezone, only_datetime=False):
+    def parse_reminder_str(text, timezone, language=None, only_datetime=False):
+        now = get_local_time(datetime.datetime.utcnow(), timezone)
 
-        # Нужны проверки, если не получилось, то возвращать false и действовать по обычному через календарь
+        languages = None
+        if language is not None:
+            # the chat language is tried first, then every other vocabulary
+            languages = [language] + [other for other in textparser.vocabularies
+                                      if other != language]
 
-        # А может через календать только когда кнопка
+        return textparser.parse_reminder(text, now, languages, only_datetime)
 
-        # дни неделя бл*
+    @staticmethod
+    def get_reminder_data_by_str(text, timezone, only_datetime=False, language=None):
+        result = UserInput.parse_reminder_str(
+            text, timezone, language, only_datetime)
+        if result.error is not None:
+            raise textparser.ParseError(result.error)
 
-        # последнее в!
+        return result.date, result.frequency, result.text
 
-        if 'в ' not in text.lower():
-            raise ValueError
 
-        text = text.strip().replace('  ', ' ')
+class Reminder(Base):
 
-        scheduled = None
-        last, rest = get_last_word_and_rest(text)
+    __tablename__ = 'reminders'
+    __table_args__ = (
+        Index('ix_reminders_datetime', 'datetime'),
+        Index('ix_reminders_chat_id_datetime', 'chat_id', 'datetime'),
+    )
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, index=True)
+    text = Column(String)
+    datetime = Column(DateTime)
+    frequency = Column(String)
 
-        freq = {
-            'ежедневно': 'DAY',
-            'еженедельно': 'WEEK',
-            'ежемесячно': 'MONTH',
-        }
+    def __init__(self, chat_id, text, datetime, frequency):
+        self.chat_id = chat_id
+        self.text = text
+        self.datetime = datetime
+        self.frequency = frequency
 
-        if last.lower() in freq.keys():
-            scheduled = freq[last]
-            text = rest
+    def __repr__(self):
+        return f'<Reminder({self.chat_id}, {self.text}, {self.date}, {self.datetime})>'
 
-        time_sep_pos = text.lower().rfind('в ')
+    @staticmethod
+    def get_reminders(engine, upcoming=True):
+        session = get_session(engine)
 
-        time = text[time_sep_pos + 2:]
-        text = text[:time_sep_pos].strip()
+        reminders = session.query(Reminder, UserSettings.timezone).outerjoin(
+            UserSettings, UserSettings.chat_id == Reminder.chat_id)
 
-        timedelta = process_time(time)
-        if timedelta is None:
-            raise ValueError
+        if upcoming:
+            now = datetime.datetime.utcnow()
+            reminders = reminders.filter(Reminder.datetime < now)
 
-        # time_list = time.split(' ')
+        default_timezone = UserSettings.get_default_settings('timezone')
+        for reminder, timezone in reminders.order_by(Reminder.datetime):
+            reminder.datetime = get_local_time(
+                reminder.datetime, timezone or default_timezone)
+            yield reminder
 
-        # h = int(time_list[0].strip())
-        # m = 0
-        # if len(time_list) == 2:
-        #     m = int(time_list[1].strip())
+        session.close()
 
-        # timedelta = datetime.timedelta(hours=h, minutes=m)
+    @staticmethod
+    def get_chat_reminders(engine, chat_id, limit=10, after=None, before=None):
+        # keyset pagination on (datetime, id), after and before are the keys
+        # of the last and first reminder of the neighbouring page
+        session = get_session(engine)
 
-        last, rest = get_last_word_and_rest(text)
+        reminders = session.query(Reminder.id, Reminder.text, Reminder.datetime,
+                                  Reminder.frequency).filter(Reminder.chat_id == chat_id)
+        if after is not None:
+            reminders = reminders.filter(or_(
+                Reminder.datetime > after[0],
+                and_(Reminder.datetime == after[0], Reminder.id > after[1])))
+        if before is not None:
+            reminders = reminders.filter(or_(
+                Reminder.datetime < before[0],
+                and_(Reminder.datetime == before[0], Reminder.id < before[1])))
+            reminders = reminders.order_by(Reminder.datetime.desc(), Reminder.id.desc())
+        else:
+            reminders = reminders.order_by(Reminder.datetime, Reminder.id)
 
-        date = None
+        rows = reminders.limit(limit + 1).all()
 
-        # словари парень!!
-        days = ('сегодня', 'завтра', 'послезавтра', 'понедельник', 'пн', 'вторник', 'вт',
-                'среда', 'ср', 'четверг', 'чт', 'пятница', 'пт', 'суббота', 'сб', 'воскресенье', 'вс')
-        months = ('января', 'февраля', 'марта', 'апреля', 'мая', 'июня',
-                  'июля', 'августа', 'сентября', 'октября', 'ноября', 'декабря')
+        session.close()
 
-        now = get_local_time(datetime.datetime.utcnow(), timezone)
-        today = datetime.datetime(now.year, now.month, now.day)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if before is not None:
+            rows.reverse()
+            has_prev, has_next = has_more, True
+        else:
+            has_prev, has_next = after is not None, has_more
 
-        last = last.lower()
+        timezone = UserSettings.get_user_settings(engine, chat_id, 'timezone')
+        local_datetimes = get_local_times([row.datetime for row in rows], timezone)
+        reminders = [ChatReminder(*row, local_datetime)
+                     for row, local_datetime in zip(rows, local_datetimes)]
 
-        if last in days:
-            if last == 'сегодня':
-                date = today
-            elif last == 'завтра':
-                date = today + relativedelta(days=1)
-            elif last == 'послезавтра':
-                date = today + relativedelta(days=2)
-            else:
-                if last == 'пн' or last == 'понедельник':
-                    weekday = 0
-                elif last == 'вт' or last == 'вторник':
-                    weekday = 1
-                elif last == 'ср' or last == 'среда':
-                    weekday = 2
-                elif last == 'чт' or last == 'четверг':
-                    weekday = 3
-                elif last == 'пт' or last == 'пятнца':
-                    weekday = 4
-                elif last == 'сб' or last == 'суббота':
-                    weekday = 5
-                elif last == 'вс' or last == 'воскресенье':
-                    weekday = 6
+        return reminders, has_prev, has_next
+
+    @staticmethod
+    def _query_due(session):
+        return session.query(Reminder.id, Reminder.chat_id, Reminder.text,
+                             Reminder.datetime, Reminder.frequency,
+                             UserSettings.language, UserSettings.timezone).outerjoin(
+            UserSettings, UserSettings.chat_id == Reminder.chat_id)
+
+    @staticmethod
+    def _to_due_reminders(rows):
+        default_language = UserSettings.get_default_settings('language')
+        default_timezone = UserSettings.get_default_settings('timezone')
+
+        return [DueReminder(*row[:5], row.language or default_language, row.timezone or default_timezone)
+                for row in rows]
+
+    @staticmethod
+    def get_reminder(engine, id):
+        session = get_session(engine)
+
+        reminder = session.query(Reminder).filter(Reminder.id == id).first()
+
+        session.close()
+
+        return reminder
+
+    @staticmethod
+    def get_schedule(engine, limit, shard_count=None, shard_index=None):
+        session = get_session(engine)
 
-                now_weekday = now.weekday()
+        schedule = session.query(Reminder.id, Reminder.datetime)
+        if shard_count:
+            schedule = schedule.filter(
+                get_shard(Reminder.chat_id, shard_count) == shard_index)
+        schedule = schedule.order_by(Reminder.datetime).limit(limit).all()
 
-                if now_weekday <= weekday:
-                    dif = weekday - now_weekday
-                else:
-                    dif = 7 - now_weekday + weekday
+        session.close()
 
-                date = today + relativedelta(days=dif)
+        return schedule
 
-            text = rest
+    @staticmethod
+    def get_earliest(engine, shard_count=None, shard_index=None):
+        session = get_session(engine)
+
+        earliest = session.query(func.min(Reminder.datetime))
+        if shard_count:
+            earliest = earliest.filter(
+                get_shard(Reminder.chat_id, shard_count) == shard_index)
+        earliest = earliest.scalar()
+
+        session.close()
+
+        return earliest
+
+    @staticmethod
+    def delete_reminder(engine, id):
+        session = get_session(engine)
+        session.query(Reminder).filter_by(id=id).delete()
+        session_commit(session)
 
-            last, rest = get_last_word_and_rest(text)
-            if last in ('в', 'во'):
-                text = rest
+        notify_reminder_changed(engine, int(id), None)
 
-        if date is None:
-            if last in months:
-                year = now.year
-                month = months.index(last) + 1
-                if month < now.month:
-                    year += 1
+    @staticmethod
+    def move_reccuring_reminder(engine, id):
+        session = get_session(engine)
+        reminder = session.query(Reminder).filter_by(id=id).first()
 
-                text = rest
-                last, rest = get_last_word_and_rest(text)
+        if reminder is not None:
+            timezone = UserSettings.get_user_settings(engine, reminder.chat_id, 'timezone')
+            next_datetime = Reminder.get_next_datetime(
+                reminder.datetime, reminder.frequency, timezone=timezone)
+            if next_datetime is None:
+                session.delete(reminder)
+            else:
+                reminder.datetime = next_datetime
 
-                day = int(last)
+            session_commit(session)
 
-                date = datetime.datetime(year, month, day)
+            notify_reminder_changed(engine, int(id), next_datetime)
 
-                text = rest
+    @staticmethod
+    def _advance(session, reminders, catch_up=CATCH_UP_ONCE, chunk_size=500):
+        # delivered reminders are removed or moved to the next time
+        if catch_up == CATCH_UP_ALL:
+            after = None
+        else:
+            after = datetime.datetime.utcnow()
 
+        removed = []
+        moved = []
+        for reminder in reminders:
+            next_datetime = None
+            if reminder.frequency is not None:
+                next_datetime = Reminder.get_next_datetime(
+                    reminder.datetime, reminder.frequency, after, reminder.timezone)
+            if next_datetime is None:
+                removed.append(reminder.id)
             else:
+                moved.append({'reminder_id': reminder.id, 'next_datetime': next_datetime})
 
-                if len(last) <= 2 and last.isdigit():
-                    day = int(last)
-                    date = datetime.datetime(now.year, now.month, day)
+        table = Reminder.__table__
+        for i in range(0, len(removed), chunk_size):
+            session.execute(table.delete().where(
+                table.c.id.in_(removed[i:i + chunk_size])))
+        if moved:
+            session.execute(table.update().where(
+                table.c.id == bindparam('reminder_id')).values(
+                datetime=bindparam('next_datetime')), moved)
 
-                    text = rest
+        return removed, moved
 
-                else:
-                    date = today
+    @staticmethod
+    def _notify_advanced(engine, removed, moved):
+        for reminder_id in removed:
+            notify_reminder_changed(engine, reminder_id, None)
+        for mapping in moved:
+            notify_reminder_changed(engine, mapping['reminder_id'], mapping['next_datetime'])
 
-        date = date + timedelta
+    @staticmethod
+    def get_occurrences(datetime, frequency, after=None, timezone=None):
+        # upcoming UTC times, lazily, rules are followed in the local time of the chat
+        if timezone is None:
+            yield from recurrence.occurrences(datetime, frequency, after)
+            return
 
-        if only_datetime and text.replace(' ', '') != '':
-            raise ValueError
+        local_after = None if after is None else get_local_time(after, timezone)
+        for occurrence in recurrence.occurrences(
+                get_local_time(datetime, timezone), frequency, local_after):
+            yield get_utc_time(occurrence, timezone)
 
-        return date, scheduled, text
+    @staticmethod
+    def get_next_datetime(datetime, frequency, after=None, timezone=None):
+        # None when the rule has ended
+        return next(Reminder.get_occurrences(datetime, frequency, after, timezone), None)
 
 
-class Reminder(Base):
+class Delivery(Base):
 
-    __tablename__ = 'reminders'
+    # outbox of due reminders, every row is one occurrence of a reminder
+    __tablename__ = 'deliveries'
+    __table_args__ = (
+        Index('ix_deliveries_status_next_attempt', 'status', 'next_attempt'),
+        Index('ix_deliveries_finished_at', 'finished_at'),
+    )
     id = Column(Integer, primary_key=True)
-    chat_id = Column(Integer, index=True)
+    key = Column(String, unique=True)
+    reminder_id = Column(Integer)
+    chat_id = Column(Integer)
     text = Column(String)
-    datetime = Column(DateTime)
     frequency = Column(String)
-
-    def __init__(self, chat_id, text, datetime, frequency):
-        self.chat_id = chat_id
-        self.text = text
-        self.datetime = datetime
-        self.frequency = frequency
+    language = Column(String)
+    due = Column(DateTime)
+    status = Column(String)
+    attempts = Column(Integer)
+    next_attempt = Column(DateTime)
+    claimed_by = Column(String)
+    claimed_until = Column(DateTime)
+    finished_at = Column(DateTime)
 
     def __repr__(self):
-        return f'<Reminder({self.chat_id}, {self.text}, {self.date}, {self.datetime})>'
+        return f'<Delivery({self.key}, {self.chat_id}, {self.status})>'
 
     @staticmethod
-    def get_reminders(engine, upcoming=True):
+    def get_key(reminder):
+        # the same occurrence of a reminder is never staged twice
+        return f'{reminder.id}:{reminder.chat_id}:{reminder.datetime:%Y%m%d%H%M%S}'
+
+    @staticmethod
+    def stage_due_reminders(engine, limit=500, catch_up=CATCH_UP_ONCE, catch_up_grace=None,
+                            shard_count=None, shard_index=None):
+        # due reminders are copied to the outbox and removed or moved to the
+        # next time in one transaction
         session = get_session(engine)
 
-        if upcoming:
-            now = datetime.datetime.utcnow()
-            reminders = session.query(Reminder).filter(
-                Reminder.datetime < now).order_by(Reminder.datetime)
-        else:
-            reminders = session.query(Reminder).order_by(Reminder.datetime)
+        now = datetime.datetime.utcnow()
+        due = Reminder._query_due(session).filter(Reminder.datetime < now)
+        if shard_count:
+            due = due.filter(get_shard(Reminder.chat_id, shard_count) == shard_index)
+        due = due.order_by(Reminder.datetime).limit(limit)
+        if engine.dialect.name == 'postgresql':
+            due = due.with_for_update(skip_locked=True, of=Reminder)
+        reminders = Reminder._to_due_reminders(due.all())
 
+        staged = []
         for reminder in reminders:
-            timezone = UserSettings.get_user_settings(
-                engine, reminder.chat_id, 'timezone')
-            if timezone is not None:
-                reminder.datetime = get_local_time(reminder.datetime, timezone)
-            yield reminder
-
-        session.close()
+            if (reminder.frequency is not None and catch_up == CATCH_UP_SKIP
+                    and catch_up_grace is not None and reminder.datetime < now - catch_up_grace):
+                continue
+
+            staged.append({'key': Delivery.get_key(reminder), 'reminder_id': reminder.id,
+                           'chat_id': reminder.chat_id, 'text': reminder.text,
+                           'frequency': reminder.frequency, 'language': reminder.language,
+                           'due': reminder.datetime, 'status': DELIVERY_PENDING,
+                           'attempts': 0, 'next_attempt': now})
+
+        if staged:
+            # occurrences staged before a crash are only advanced
+            existing = {key for key, in session.query(Delivery.key).filter(
+                Delivery.key.in_([mapping['key'] for mapping in staged]))}
+            staged = [mapping for mapping in staged if mapping['key'] not in existing]
+
+        try:
+            if staged:
+                session.execute(Delivery.__table__.insert(), staged)
+            removed, moved = Reminder._advance(session, reminders, catch_up)
+            session.commit()
+        except IntegrityError:
+            # another worker staged the same reminders first
+            session.rollback()
+            return 0
+        finally:
+            session.close()
+
+        Reminder._notify_advanced(engine, removed, moved)
+
+        return len(reminders)
 
     @staticmethod
-    def get_reminder(engine, id):
+    def claim_pending(engine, worker_id, limit=500, lease=300, shard_count=None, shard_index=None,
+                      per_chat=None):
+        # per_chat caps the deliveries of one chat, they have to be sent before the lease expires
         session = get_session(engine)
 
-        reminder = session.query(Reminder).filter(Reminder.id == id).first()
+        now = datetime.datetime.utcnow()
+        claimed_until = now + datetime.timedelta(seconds=lease)
+
+        unclaimed = or_(Delivery.claimed_until.is_(None),
+                        Delivery.claimed_until < now)
+        pending = session.query(Delivery.id).filter(
+            Delivery.status == DELIVERY_PENDING, Delivery.next_attempt <= now, unclaimed)
+        if shard_count:
+            pending = pending.filter(get_shard(Delivery.chat_id, shard_count) == shard_index)
+        if per_chat:
+            ranked = pending.add_columns(func.row_number().over(
+                partition_by=Delivery.chat_id, order_by=Delivery.next_attempt).label('position')).subquery()
+            # postgres does not lock rows of a query with a window function
+            pending = session.query(Delivery.id).filter(Delivery.id.in_(
+                select([ranked.c.id]).where(ranked.c.position <= per_chat)))
+        pending = pending.order_by(Delivery.next_attempt).limit(limit)
+
+        claim = {'claimed_by': worker_id, 'claimed_until': claimed_until}
+        if engine.dialect.name == 'postgresql':
+            ids = [id for id, in pending.with_for_update(skip_locked=True)]
+            session.query(Delivery).filter(Delivery.id.in_(ids)).update(
+                claim, synchronize_session=False)
+        else:
+            pending_ids = pending.subquery()
+            session.query(Delivery).filter(
+                Delivery.id.in_(select([pending_ids.c.id])), unclaimed).update(
+                claim, synchronize_session=False)
+        session.commit()
+
+        rows = session.query(Delivery.id, Delivery.reminder_id, Delivery.chat_id, Delivery.text,
+                             Delivery.frequency, Delivery.language, Delivery.due,
+                             Delivery.attempts).filter(
+            Delivery.claimed_by == worker_id,
+            Delivery.claimed_until == claimed_until).order_by(Delivery.due).all()
 
         session.close()
 
-        return reminder
+        return [PendingDelivery(*row) for row in rows]
 
     @staticmethod
-    def delete_reminder(engine, id):
+    def record_results(engine, deliveries, statuses, worker_id, max_attempts=5, backoff=30):
+        # statuses maps delivery ids to SENT, REJECTED or FAILED, failed deliveries
+        # are retried with exponential backoff
+        now = datetime.datetime.utcnow()
+
+        updates = []
+        for pending in deliveries:
+            status = statuses.get(pending.id, DELIVERY_FAILED)
+            attempts = pending.attempts + 1
+            next_attempt = None
+            finished_at = now
+
+            if status == DELIVERY_FAILED and attempts < max_attempts:
+                status = DELIVERY_PENDING
+                next_attempt = now + datetime.timedelta(seconds=backoff * 2 ** (attempts - 1))
+                finished_at = None
+
+            updates.append({'delivery_id': pending.id, 'new_status': status,
+                            'new_attempts': attempts, 'new_next_attempt': next_attempt,
+                            'new_finished_at': finished_at})
+
+        if updates:
+            table = Delivery.__table__
+            session = get_session(engine)
+            session.execute(table.update().where(and_(
+                table.c.id == bindparam('delivery_id'), table.c.claimed_by == worker_id)).values(
+                status=bindparam('new_status'), attempts=bindparam('new_attempts'),
+                next_attempt=bindparam('new_next_attempt'), finished_at=bindparam('new_finished_at'),
+                claimed_by=None, claimed_until=None), updates)
+            session_commit(session)
+
+    @staticmethod
+    def release(engine, ids, worker_id):
+        # claimed deliveries that will not be sent by this worker
         session = get_session(engine)
-        session.query(Reminder).filter_by(id=id).delete()
+        session.query(Delivery).filter(
+            Delivery.id.in_(ids), Delivery.claimed_by == worker_id).update(
+            {'claimed_by': None, 'claimed_until': None}, synchronize_session=False)
         session_commit(session)
 
     @staticmethod
-    def move_reccuring_reminder(engine, id):
+    def get_next_attempt(engine, shard_count=None, shard_index=None):
+        # earliest time a pending delivery can be claimed, either its next attempt
+        # or the end of the lease of a worker that did not report back
         session = get_session(engine)
-        reminder = session.query(Reminder).filter_by(id=id).first()
 
-        if reminder is not None:
-            if reminder.frequency == 'DAY':
-                timedelta = relativedelta(days=1)
-            elif reminder.frequency == 'WEEK':
-                timedelta = relativedelta(days=7)
-            elif reminder.frequency == 'MONTH':
-                timedelta = relativedelta(months=1)
-            elif reminder.frequency == 'WORKDAYS':
-                weekday = reminder.datetime.weekday() + 1
-                if weekday in (1, 2, 3, 4):
-                    timedelta = relativedelta(days=1)
-                else:
-                    timedelta = relativedelta(days=(7 - weekday + 1))
-            elif reminder.frequency == 'WEEKENDS':
-                weekday = reminder.datetime.weekday() + 1
-                if weekday == 6:
-                    timedelta = relativedelta(days=1)
-                elif weekday == 7:
-                    timedelta = relativedelta(days=7)
-                else:
-                    timedelta = relativedelta(days=(6 - weekday))
-
-            reminder.datetime += timedelta
+        now = datetime.datetime.utcnow()
+        pending = session.query(Delivery).filter(Delivery.status == DELIVERY_PENDING)
+        if shard_count:
+            pending = pending.filter(get_shard(Delivery.chat_id, shard_count) == shard_index)
+        next_attempt = pending.filter(
+            or_(Delivery.claimed_until.is_(None), Delivery.claimed_until < now)).with_entities(
+            func.min(Delivery.next_attempt)).scalar()
+        claimed_until = pending.filter(Delivery.claimed_until >= now).with_entities(
+            func.min(Delivery.claimed_until)).scalar()
 
-            session_commit(session)
+        session.close()
+
+        times = [when for when in (next_attempt, claimed_until) if when is not None]
+        return min(times) if times else None
+
+    @staticmethod
+    def get_text(engine, id, chat_id):
+        # None when the delivery was pruned or belongs to another chat
+        session = get_session(engine)
+        row = session.query(Delivery.text).filter(
+            Delivery.id == id, Delivery.chat_id == chat_id).first()
+        session.close()
+
+        return None if row is None else row.text
+
+    @staticmethod
+    def prune(engine, before):
+        # finished deliveries are kept for a while to show what was sent
+        table = Delivery.__table__
+        session = get_session(engine)
+        pruned = session.execute(table.delete().where(and_(
+            table.c.status != DELIVERY_PENDING, table.c.finished_at < before))).rowcount
+        session_commit(session)
+
+        return pruned
 
 
 class UserSettings(Base):
@@ -394,7 +628,13 @@ class UserSettings(Base):
         for key in kwargs:
             setattr(user_settings, key, kwargs[key])
 
-        session_commit(session)
+        settings = UserSettings._to_dict(user_settings)
+        try:
+            session_commit(session)
+        finally:
+            settings_cache.invalidate((engine, chat_id))
+
+        settings_cache.set((engine, chat_id), settings)
 
     @staticmethod
     def get_default_settings(settings_name):
@@ -407,33 +647,207 @@ class UserSettings(Base):
 
     @staticmethod
     def get_user_settings(engine, chat_id, settings_name):
-        session = get_session(engine)
-        user_settings = session.query(
-            UserSettings).filter_by(chat_id=chat_id).first()
-        session.close()
+        settings = settings_cache.get((engine, chat_id))
+        if settings is None:
+            session = get_session(engine)
+            user_settings = session.query(
+                UserSettings).filter_by(chat_id=chat_id).first()
+            session.close()
+
+            settings = UserSettings._to_dict(user_settings)
+            settings_cache.set((engine, chat_id), settings)
 
-        value = None
-        if user_settings is not None:
-            value = getattr(user_settings, settings_name)
+        value = settings.get(settings_name)
 
         if value is None:
             value = UserSettings.get_default_settings(settings_name)
 
         return value
 
+    @staticmethod
+    def _to_dict(user_settings):
+        if user_settings is None:
+            return {}
+
+        return {column.name: getattr(user_settings, column.name)
+                for column in UserSettings.__table__.columns}
+
+
+class SettingsCache:
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                expires, value = item
+                if expires > time.monotonic():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._items[key]
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def cache_info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._items))
+
+
+settings_cache = SettingsCache()
+
+
+class MemoryInputStore:
+
+    # conversations are kept as transient UserInput objects
+    def __init__(self, maxsize=100000, ttl=86400):
+        self._items = SettingsCache(maxsize, ttl)
+
+    def get(self, chat_id):
+        return self._items.get(chat_id)
+
+    def set(self, chat_id, user_input):
+        self._items.set(chat_id, user_input)
+
+    def delete(self, chat_id, session=None):
+        self._items.invalidate(chat_id)
+
+
+class DatabaseInputStore(MemoryInputStore):
+
+    # writes every step through to user_inputs, so conversations survive a restart
+    def __init__(self, engine, maxsize=100000, ttl=86400):
+        super().__init__(maxsize, ttl)
+        self.engine = engine
+
+    def get(self, chat_id):
+        user_input = super().get(chat_id)
+        if user_input is None:
+            session = get_session(self.engine)
+            user_input = session.query(UserInput).filter_by(chat_id=chat_id).first()
+            if user_input is not None:
+                session.expunge(user_input)
+                super().set(chat_id, user_input)
+            session.close()
+
+        return user_input
+
+    def set(self, chat_id, user_input):
+        session = get_session(self.engine)
+        session.merge(UserInput(chat_id=chat_id, text=user_input.text,
+                                date=user_input.date, frequency=user_input.frequency))
+        session_commit(session)
+
+        super().set(chat_id, user_input)
+
+    def delete(self, chat_id, session=None):
+        super().delete(chat_id)
+
+        if session is None:
+            session = get_session(self.engine)
+            session.query(UserInput).filter_by(chat_id=chat_id).delete()
+            session_commit(session)
+        else:
+            # committed by the caller
+            session.query(UserInput).filter_by(chat_id=chat_id).delete()
+
+
+input_stores = {}
+
+
+def get_input_store(engine):
+    store = input_stores.get(engine)
+    if store is None:
+        store = input_stores.setdefault(engine, MemoryInputStore())
+    return store
+
+
+def set_input_store(engine, store):
+    input_stores[engine] = store
+
 
 def get_session(engine):
-    Session = sessionmaker(bind=engine)
+    Session = session_factories.get(engine)
+    if Session is None:
+        Session = session_factories.setdefault(engine, sessionmaker(bind=engine))
     return Session()
 
 
-def open_database(db_url):
-    engine = create_engine(db_url, echo=True)
+def open_database(db_url, echo=False, pool_size=5, max_overflow=10, pool_recycle=3600):
+    url = make_url(db_url)
+    sqlite = url.get_backend_name() == 'sqlite'
+
+    engine_kwargs = {'echo': echo}
+    if sqlite:
+        # sessions are also opened from the job queue and delivery threads
+        engine_kwargs['connect_args'] = {'check_same_thread': False}
+        if url.database and url.database != ':memory:':
+            engine_kwargs.update(poolclass=QueuePool, pool_size=pool_size,
+                                 max_overflow=max_overflow)
+    else:
+        engine_kwargs.update(pool_size=pool_size, max_overflow=max_overflow,
+                             pool_pre_ping=True, pool_recycle=pool_recycle)
+
+    engine = create_engine(url, **engine_kwargs)
+    if sqlite:
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+
     Base.metadata.create_all(engine)
+    migrate_database(engine)
+
+    session_factories[engine] = sessionmaker(bind=engine)
 
     return engine
 
 
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def migrate_database(engine):
+    # create_all skips existing tables, so columns and indexes added later are created here
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=engine.dialect)
+                engine.execute(
+                    f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+
+
 def session_commit(session):
     try:
         session.commit()
@@ -441,6 +855,27 @@ def session_commit(session):
         session.close()
 
 
+def save_reminder(engine, session, reminder):
+    session.add(reminder)
+    session.flush()
+    reminder_id, when = reminder.id, reminder.datetime
+
+    session_commit(session)
+
+    notify_reminder_changed(engine, reminder_id, when)
+
+
+def get_shard(chat_id, shard_count):
+    # group chats have negative ids and sql keeps the sign of the remainder
+    return (chat_id % shard_count + shard_count) % shard_count
+
+
+def notify_reminder_changed(engine, reminder_id, when):
+    # when is None for removed reminders
+    for listener in reminder_listeners:
+        listener(engine, reminder_id, when)
+
+
 def get_utc_time(datetime, timezone):
     return change_timezone(datetime, timezone, 'utc')
 
@@ -449,15 +884,58 @@ def get_local_time(datetime, timezone):
     return change_timezone(datetime, 'utc', timezone)
 
 
+def get_local_times(datetimes, timezone):
+    return change_timezones(datetimes, 'utc', timezone)
+
+
+def get_utc_times(datetimes, timezone):
+    return change_timezones(datetimes, timezone, 'utc')
+
+
+@functools.lru_cache(maxsize=None)
+def get_timezone(timezone):
+    return pytz.timezone(timezone)
+
+
+@functools.lru_cache(maxsize=None)
+def get_fixed_offset(timezone):
+    # offset from UTC for zones without DST, None for the others;
+    # the sign of Etc/GMT zones is inverted, Etc/GMT-5 is UTC+5
+    if UTC_NAME_RE.match(timezone):
+        return datetime.timedelta(0)
+
+    match = GMT_OFFSET_RE.match(timezone)
+    if match is None:
+        return None
+
+    hours = int(match.group(2))
+    return datetime.timedelta(hours=-hours if match.group(1) == '+' else hours)
+
+
 def change_timezone(datetime, timezone1, timezone2):
-    timezone1_ = pytz.timezone(timezone1)
-    timezone2_ = pytz.timezone(timezone2)
+    offset1 = get_fixed_offset(timezone1)
+    offset2 = get_fixed_offset(timezone2)
+    if offset1 is not None and offset2 is not None:
+        return datetime + (offset2 - offset1)
+
+    timezone1_ = get_timezone(timezone1)
+    timezone2_ = get_timezone(timezone2)
 
     timezone1_dt = timezone1_.localize(datetime, is_dst=None)
 
     return timezone1_dt.astimezone(timezone2_).replace(tzinfo=None)
 
 
+def change_timezones(datetimes, timezone1, timezone2):
+    offset1 = get_fixed_offset(timezone1)
+    offset2 = get_fixed_offset(timezone2)
+    if offset1 is not None and offset2 is not None:
+        offset = offset2 - offset1
+        return [datetime + offset for datetime in datetimes]
+
+    return [change_timezone(datetime, timezone1, timezone2) for datetime in datetimes]
+
+
 def process_date(date, timezone):
 
     # Тут таймзоун вообще не уместен!
@@ -500,14 +978,3 @@ def process_time(time_str):
         return None
 
     return datetime.timedelta(hours=hours, minutes=minutes)
-
-
-def get_last_word_and_rest(text, sep=' '):
-    if sep in text:
-        last = text.split(sep)[-1]
-        rest = text.replace(sep + last, '')
-    else:
-        last = text
-        rest = ''
-
-    return last, rest
@@ -0,0 +1,152 @@
+import time
+import logging
+import datetime
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from telegram.error import TelegramError, RetryAfter, BadRequest, NetworkError
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+SENT = 'SENT'
+REJECTED = 'REJECTED'
+FAILED = 'FAILED'
+
+# due is the UTC time the message was meant for, it is used for the delivery lag
+Message = namedtuple('Message', 'key chat_id text reply_markup due', defaults=(None,))
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+    def is_idle(self):
+        with self._lock:
+            self._refill()
+            return self._tokens >= self.capacity
+
+
+class DeliveryPool:
+
+    def __init__(self, workers=8, global_rate=30, chat_rate=1, max_retries=3, backoff=1):
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='delivery')
+        self._max_retries = max_retries
+        self._backoff = backoff
+
+        self._global_bucket = TokenBucket(global_rate)
+        self._chat_rate = chat_rate
+        self._chat_buckets = OrderedDict()
+        self._chat_buckets_lock = threading.Lock()
+
+    def _get_chat_bucket(self, chat_id):
+        with self._chat_buckets_lock:
+            bucket = self._chat_buckets.pop(chat_id, None)
+            if bucket is None:
+                bucket = TokenBucket(self._chat_rate, 1)
+                # buckets that refilled are equivalent to new ones
+                for idle_chat_id in list(self._chat_buckets)[:len(self._chat_buckets) // 2]:
+                    if self._chat_buckets[idle_chat_id].is_idle():
+                        del self._chat_buckets[idle_chat_id]
+            self._chat_buckets[chat_id] = bucket
+
+            return bucket
+
+    def get_chat_quota(self, seconds):
+        # messages one chat can be sent in seconds
+        return max(1, int(seconds * self._chat_rate))
+
+    def deliver(self, bot, messages):
+        chats = OrderedDict()
+        for message in messages:
+            chats.setdefault(message.chat_id, []).append(message)
+
+        results = {}
+        done = threading.Semaphore(0)
+        for chat_messages in chats.values():
+            self._executor.submit(self._send_chat, bot, iter(chat_messages), results, done)
+
+        for _ in chats:
+            done.acquire()
+
+        return results
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+    def _send_chat(self, bot, messages, results, done):
+        # messages of one chat are sent one after another, each one is queued
+        # behind the other chats only when the previous one is finished
+        message = next(messages, None)
+        if message is None:
+            done.release()
+            return
+
+        try:
+            chat_bucket = self._get_chat_bucket(message.chat_id)
+            results[message.key] = self._send(bot, message, chat_bucket)
+        except Exception:
+            logger.exception('Message to chat %s failed', message.chat_id)
+            results[message.key] = FAILED
+
+        metrics.deliveries.inc(status=results[message.key])
+        self._executor.submit(self._send_chat, bot, messages, results, done)
+
+    def _send(self, bot, message, chat_bucket):
+        for attempt in range(self._max_retries + 1):
+            chat_bucket.acquire()
+            self._global_bucket.acquire()
+
+            try:
+                bot.send_message(chat_id=message.chat_id, text=message.text,
+                                 reply_markup=message.reply_markup)
+                if message.due is not None:
+                    lag = datetime.datetime.utcnow() - message.due
+                    metrics.delivery_lag_seconds.observe(lag.total_seconds())
+                return SENT
+            except RetryAfter as e:
+                metrics.delivery_retries.inc(reason='retry_after')
+                chat_bucket.pause(e.retry_after)
+                # a wait longer than the chat interval comes from the global flood limit,
+                # the other workers would only collect more 429s
+                if e.retry_after > 1 / self._chat_rate:
+                    self._global_bucket.pause(e.retry_after)
+            except BadRequest:
+                logger.exception('Message to chat %s rejected', message.chat_id)
+                return REJECTED
+            except NetworkError:
+                metrics.delivery_retries.inc(reason='network')
+                time.sleep(self._backoff * 2 ** attempt)
+            except TelegramError:
+                logger.exception('Message to chat %s rejected', message.chat_id)
+                return REJECTED
+
+        return FAILED
@@ -0,0 +1,111 @@
+import pytz
+import functools
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from . import language
+from .language import translate
+
+
+class FrozenInlineKeyboardMarkup(InlineKeyboardMarkup):
+
+    # shared between chats, the json payload is serialized once
+    def __init__(self, inline_keyboard, **kwargs):
+        super().__init__(inline_keyboard, **kwargs)
+        self._json = super().to_json()
+
+    def to_json(self):
+        return self._json
+
+
+def _main_menu_rows(lang):
+    button_new_reminder = InlineKeyboardButton(
+        translate('newReminder', lang) + ' 🕭', callback_data='NEW_REMINDER;')
+    button_new_recc_reminder = InlineKeyboardButton(
+        translate('newRecReminder', lang) + ' ♲', callback_data='NEW_REMINDER;RECC')
+    button_reminders_list = InlineKeyboardButton(
+        translate('remindersList', lang) + ' 🗓', callback_data='REMINDER_LIST;')
+
+    return [
+        [button_new_reminder],
+        [button_new_recc_reminder],
+        [button_reminders_list],
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def main_menu(lang):
+    return FrozenInlineKeyboardMarkup(_main_menu_rows(lang))
+
+
+@functools.lru_cache(maxsize=None)
+def start_menu(lang):
+    button_settings = InlineKeyboardButton(
+        translate('settings', lang) + ' ⛭', callback_data='GETSETTINGS;')
+
+    return FrozenInlineKeyboardMarkup(_main_menu_rows(lang) + [[button_settings]])
+
+
+@functools.lru_cache(maxsize=None)
+def settings_menu(lang):
+    button_language = InlineKeyboardButton(
+        translate('lang', lang), callback_data='SETTINGS;LANG')
+    button_timezone = InlineKeyboardButton(
+        translate('timezone', lang), callback_data='SETTINGS;TIMEZONE')
+
+    return FrozenInlineKeyboardMarkup([
+        [button_language],
+        [button_timezone],
+    ])
+
+
+@functools.lru_cache(maxsize=None)
+def language_menu():
+    return FrozenInlineKeyboardMarkup(
+        [[InlineKeyboardButton(lang, callback_data='SETTINGS;LANG;' + lang)]
+         for lang in language.tables])
+
+
+@functools.lru_cache(maxsize=None)
+def timezone_menu():
+    timezones = [tz for tz in pytz.all_timezones if 'Etc/GMT' in tz]
+
+    keyboard = []
+    for i in range(0, len(timezones), 3):
+        keyboard.append([
+            InlineKeyboardButton(timezone.replace('Etc/', ''),
+                                 callback_data='SETTINGS;TIMEZONE;' + timezone)
+            for timezone in timezones[i:i + 3]])
+
+    return FrozenInlineKeyboardMarkup(keyboard)
+
+
+@functools.lru_cache(maxsize=None)
+def recurrence_menu(lang):
+    button_day = InlineKeyboardButton(
+        translate('recDay', lang), callback_data='RECCURING;DAY')
+    button_week = InlineKeyboardButton(
+        translate('recWeek', lang), callback_data='RECCURING;WEEK')
+    button_month = InlineKeyboardButton(
+        translate('recMonth', lang), callback_data='RECCURING;MONTH')
+    button_workdays = InlineKeyboardButton(
+        translate('recWork', lang), callback_data='RECCURING;WORKDAYS')
+    button_weekends = InlineKeyboardButton(
+        translate('recWeekEnds', lang), callback_data='RECCURING;WEEKENDS')
+
+    return FrozenInlineKeyboardMarkup(
+        [[button_day], [button_week], [button_month], [button_workdays], [button_weekends]])
+
+
+@functools.lru_cache(maxsize=None)
+def cancel_menu(lang):
+    cancel = InlineKeyboardButton(
+        translate('cancel', lang), callback_data='CANCEL;')
+
+    return FrozenInlineKeyboardMarkup([[cancel]])
+
+
+def preload():
+    language_menu()
+    timezone_menu()
+    for lang in language.tables:
+        for keyboard in (main_menu, start_menu, settings_menu, recurrence_menu, cancel_menu):
+            keyboard(lang)
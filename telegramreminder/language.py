@@ -1,17 +1,83 @@
 import configparser
 import os
+import pickle
 
 
 dir_path = os.path.dirname(os.path.abspath(__file__))
 file_path = os.path.join(dir_path, "translations.ini")
 
-configparser = configparser.ConfigParser() 
-with open(file_path, encoding='utf-8') as f:
-    configparser.read_file(f)
+# set it to a file path to skip parsing translations.ini on startup
+CACHE_ENV = 'TELEGRAMREMINDER_TRANSLATIONS_CACHE'
+
+DEFAULT_LANGUAGE = 'ENG'
+LIST_STRINGS = ('Months', 'WeekDays')
+
+
+def read_translations(path=file_path):
+    parser = configparser.ConfigParser(interpolation=None)
+    # keys are looked up as they are written
+    parser.optionxform = str
+    with open(path, encoding='utf-8') as f:
+        parser.read_file(f)
+
+    return {language: dict(parser[language]) for language in parser.sections()}
+
+
+def load_translations(path=file_path, cache_path=None):
+    mtime = os.path.getmtime(path)
+
+    if cache_path:
+        try:
+            with open(cache_path, 'rb') as f:
+                cached_mtime, translations = pickle.load(f)
+            if cached_mtime == mtime:
+                return translations
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            pass
+
+    translations = read_translations(path)
+
+    if cache_path:
+        try:
+            with open(cache_path, 'wb') as f:
+                pickle.dump((mtime, translations), f, pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            pass
+
+    return translations
+
+
+def compile_translations(translations):
+    # every language falls back to the default language, then to the key itself
+    default = translations.get(DEFAULT_LANGUAGE, {})
+
+    tables = {}
+    lists = {}
+    for language, strings in translations.items():
+        table = dict(default)
+        table.update(strings)
+        tables[language] = table
+        lists[language] = {string: tuple(table[string].split(','))
+                           for string in LIST_STRINGS if string in table}
+
+    return tables, lists
+
+
+tables, lists = compile_translations(
+    load_translations(cache_path=os.environ.get(CACHE_ENV)))
 
 
 def translate(string, language):
-    if language in configparser and string in configparser[language]:
-        return configparser[language][string]
-   
-    return string
\ No newline at end of file
+    table = tables.get(language)
+    if table is None:
+        table = tables.get(DEFAULT_LANGUAGE, {})
+
+    return table.get(string, string)
+
+
+def translate_list(string, language):
+    language_lists = lists.get(language)
+    if language_lists is None:
+        language_lists = lists.get(DEFAULT_LANGUAGE, {})
+
+    return language_lists.get(string, ())
@@ -0,0 +1,307 @@
+import time
+import socket
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sqlalchemy import event
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    def escape(value):
+        return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+
+    kind = None
+
+    def __init__(self, registry, name, help, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _labels(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}')
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def __init__(self, registry, name, help, labelnames=()):
+        super().__init__(registry, name, help, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+        self.registry.emit(self.kind, self.name, key, amount)
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._labels(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+
+        return [f'{self.name}{_format_labels(key)} {_format_value(value)}'
+                for key, value in values]
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+        self.registry.emit(self.kind, self.name, key, value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self._values.items())
+
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket_key = key + (('le', _format_value(bound)),)
+                lines.append(f'{self.name}_bucket{_format_labels(bucket_key)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {cumulative}')
+
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._caches = {}
+        self._sinks = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(self, name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, help, labelnames, buckets))
+
+    def watch_cache(self, name, cache):
+        # cache is anything with cache_info(), like functools.lru_cache functions
+        with self._lock:
+            self._caches[name] = cache
+
+    def add_sink(self, sink):
+        self._sinks.append(sink)
+
+    def remove_sink(self, sink):
+        self._sinks.remove(sink)
+
+    def emit(self, kind, name, labels, value):
+        for sink in self._sinks:
+            try:
+                sink(kind, name, labels, value)
+            except Exception:
+                logger.exception('Metrics sink %r failed', sink)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+            caches = sorted(self._caches.items())
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        if caches:
+            infos = [(name, cache.cache_info()) for name, cache in caches]
+            for field, suffix, kind in (('hits', 'hits_total', 'counter'),
+                                        ('misses', 'misses_total', 'counter'),
+                                        ('currsize', 'size', 'gauge')):
+                metric_name = f'telegramreminder_cache_{suffix}'
+                lines.append(f'# HELP {metric_name} Cache {field}')
+                lines.append(f'# TYPE {metric_name} {kind}')
+                lines.extend(f'{metric_name}{_format_labels((("cache", name),))} {getattr(info, field)}'
+                             for name, info in infos)
+
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdSink:
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='telegramreminder'):
+        self._address = (host, port)
+        self._prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, kind, name, labels, value):
+        if kind == 'counter':
+            data = f'{self._prefix}.{name}:{value}|c'
+        else:
+            data = f'{self._prefix}.{name}:{value}|h'
+        if labels:
+            data += '|#' + ','.join(f'{label}:{label_value}' for label, label_value in labels)
+
+        self._socket.sendto(data.encode('utf-8'), self._address)
+
+
+registry = Registry()
+
+handler_seconds = registry.histogram(
+    'telegramreminder_handler_seconds', 'Update handler latency', ('handler',))
+handler_errors = registry.counter(
+    'telegramreminder_handler_errors_total', 'Update handlers that raised', ('handler',))
+handler_queries = registry.histogram(
+    'telegramreminder_handler_queries', 'Database queries per handler call', ('handler',),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+db_query_seconds = registry.histogram(
+    'telegramreminder_db_query_seconds', 'Database query time', ('handler',))
+send_tick_seconds = registry.histogram(
+    'telegramreminder_send_tick_seconds', 'Duration of one delivery tick')
+send_batch_size = registry.histogram(
+    'telegramreminder_send_batch_size', 'Reminders claimed per delivery tick',
+    buckets=(0, 1, 10, 50, 100, 250, 500, 1000, 5000))
+delivery_lag_seconds = registry.histogram(
+    'telegramreminder_delivery_lag_seconds', 'Send time minus the reminder time',
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 3600))
+deliveries = registry.counter(
+    'telegramreminder_deliveries_total', 'Delivered messages by status', ('status',))
+delivery_retries = registry.counter(
+    'telegramreminder_delivery_retries_total', 'Send retries by reason', ('reason',))
+
+
+_local = threading.local()
+_instrumented_engines = set()
+
+
+def current_handler():
+    return getattr(_local, 'handler', None) or 'none'
+
+
+@contextmanager
+def track(handler):
+    # database queries made by this thread are attributed to the handler
+    previous = getattr(_local, 'handler', None), getattr(_local, 'queries', 0)
+    _local.handler = handler
+    _local.queries = 0
+    try:
+        yield
+    finally:
+        handler_queries.observe(_local.queries, handler=handler)
+        _local.handler, _local.queries = previous
+
+
+def timed_handler(name, callback):
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        with track(name):
+            try:
+                return callback(*args, **kwargs)
+            except Exception:
+                handler_errors.inc(handler=name)
+                raise
+            finally:
+                handler_seconds.observe(time.perf_counter() - start, handler=name)
+
+    return wrapper
+
+
+def instrument_engine(engine):
+    if engine in _instrumented_engines:
+        return
+    _instrumented_engines.add(engine)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        _local.queries = getattr(_local, 'queries', 0) + 1
+        db_query_seconds.observe(elapsed, handler=current_handler())
+
+
+def serve(port, host='0.0.0.0', registry=registry):
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            data = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+
+    return server
@@ -0,0 +1,170 @@
+import re
+import datetime
+import functools
+from dateutil.relativedelta import relativedelta
+from dateutil.rrule import rrulestr
+from .language import translate, translate_list
+
+
+# the recurrence buttons, they keep their closed forms
+FREQUENCIES = ('DAY', 'WEEK', 'MONTH', 'WORKDAYS', 'WEEKENDS')
+
+# other schedules are a subset of the iCalendar RRULE, e.g. FREQ=MONTHLY;BYDAY=2TU,
+# the time of day is the one of the reminder
+RULE_PARTS = ('FREQ', 'INTERVAL', 'BYDAY', 'BYMONTHDAY', 'BYMONTH', 'BYSETPOS', 'UNTIL')
+RULE_FREQUENCIES = ('DAILY', 'WEEKLY', 'MONTHLY', 'YEARLY')
+# translation keys of the periods, with and without an interval
+PERIODS = {'DAILY': ('DAY', 'everyDays'), 'WEEKLY': ('WEEK', 'everyWeeks'),
+           'MONTHLY': ('MONTH', 'everyMonths'), 'YEARLY': ('YEAR', 'everyYears')}
+WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+FIXED_PERIODS = {'DAILY': 'DAY', 'WEEKLY': 'WEEK', 'MONTHLY': 'MONTH'}
+FIXED_WEEKDAYS = {('FR', 'MO', 'TH', 'TU', 'WE'): 'WORKDAYS', ('SA', 'SU'): 'WEEKENDS'}
+FIXED_DAYS = {'WORKDAYS': (0, 1, 2, 3, 4), 'WEEKENDS': (5, 6)}
+
+BYDAY_RE = re.compile(r'^([+-]?\d{1,2})?(MO|TU|WE|TH|FR|SA|SU)$')
+
+
+def make_rule(freq, interval=1, byday=()):
+    # schedules of the buttons are stored as their codes
+    if interval == 1 and not byday and freq in FIXED_PERIODS:
+        return FIXED_PERIODS[freq]
+    if freq == 'WEEKLY' and interval == 1 and tuple(sorted(byday)) in FIXED_WEEKDAYS:
+        return FIXED_WEEKDAYS[tuple(sorted(byday))]
+
+    parts = [f'FREQ={freq}']
+    if interval != 1:
+        parts.append(f'INTERVAL={interval}')
+    if byday:
+        parts.append('BYDAY=' + ','.join(byday))
+
+    return ';'.join(parts)
+
+
+def _split_rule(frequency):
+    parts = {}
+    for part in frequency.split(';'):
+        name, _, value = part.partition('=')
+        if name not in RULE_PARTS or name in parts or not value:
+            raise ValueError(f'bad frequency {frequency}')
+        parts[name] = value
+
+    if parts.get('FREQ') not in RULE_FREQUENCIES:
+        raise ValueError(f'bad frequency {frequency}')
+    if not parts.get('INTERVAL', '1').isdecimal() or int(parts.get('INTERVAL', '1')) < 1:
+        raise ValueError(f'bad frequency {frequency}')
+
+    return parts
+
+
+@functools.lru_cache(maxsize=1024)
+def get_rule(frequency):
+    # parsed once per rule, every reminder only replaces the start
+    _split_rule(frequency)
+    try:
+        return rrulestr(frequency, dtstart=datetime.datetime(2000, 1, 1))
+    except (ValueError, TypeError):
+        raise ValueError(f'bad frequency {frequency}')
+
+
+def is_valid(frequency):
+    if frequency in FREQUENCIES:
+        return True
+
+    try:
+        get_rule(frequency)
+    except ValueError:
+        return False
+
+    return True
+
+
+def _get_next_fixed(datetime, frequency, after=None):
+    # first occurrence later than after, but at least one period ahead
+    if after is None or after < datetime:
+        after = datetime
+
+    if frequency in ('DAY', 'WEEK'):
+        period = 1 if frequency == 'DAY' else 7
+        periods = (after - datetime).days // period + 1
+        return datetime + relativedelta(days=periods * period)
+
+    if frequency == 'MONTH':
+        months = (after.year - datetime.year) * 12 + after.month - datetime.month
+        next_datetime = datetime + relativedelta(months=months)
+        if next_datetime <= after:
+            next_datetime = datetime + relativedelta(months=months + 1)
+        return next_datetime
+
+    days = (after - datetime).days + 1
+    return _get_next_day(datetime + relativedelta(days=days), FIXED_DAYS[frequency])
+
+
+def _get_next_day(datetime, weekdays):
+    while datetime.weekday() not in weekdays:
+        datetime += relativedelta(days=1)
+
+    return datetime
+
+
+def occurrences(datetime, frequency, after=None):
+    # upcoming occurrences later than after, lazily, finite only with UNTIL
+    if frequency not in FREQUENCIES:
+        if after is None or after < datetime:
+            after = datetime
+        yield from get_rule(frequency).replace(dtstart=datetime).xafter(after)
+        return
+
+    next_datetime = _get_next_fixed(datetime, frequency, after)
+    while True:
+        yield next_datetime
+        next_datetime = _get_next_fixed(next_datetime, frequency)
+
+
+def get_next_datetime(datetime, frequency, after=None):
+    # None when the rule has ended
+    return next(occurrences(datetime, frequency, after), None)
+
+
+def get_first_datetime(datetime, frequency):
+    # the first occurrence not earlier than datetime, "every monday" starts on a monday
+    if frequency in FIXED_DAYS:
+        return _get_next_day(datetime, FIXED_DAYS[frequency])
+    if frequency in FREQUENCIES:
+        return datetime
+
+    return get_rule(frequency).replace(dtstart=datetime).after(datetime, inc=True)
+
+
+@functools.lru_cache(maxsize=1024)
+def describe(frequency, language):
+    if frequency in FREQUENCIES:
+        return translate(frequency, language)
+
+    try:
+        parts = _split_rule(frequency)
+    except ValueError:
+        return frequency
+
+    period, periods = PERIODS[parts['FREQ']]
+    interval = parts.get('INTERVAL', '1')
+    if interval == '1':
+        text = translate(period, language)
+    else:
+        text = translate(periods, language).format(interval)
+
+    if 'BYDAY' in parts:
+        weekday_names = translate_list('WeekDays', language)
+        days = []
+        for byday in parts['BYDAY'].split(','):
+            match = BYDAY_RE.match(byday)
+            if match is None or len(weekday_names) != 7:
+                return frequency
+            n, weekday = match.groups()
+            name = weekday_names[WEEKDAYS.index(weekday)]
+            days.append(name if n is None else f'{n} {name}')
+        text += ': ' + ','.join(days)
+    elif 'BYMONTHDAY' in parts:
+        text += ': ' + parts['BYMONTHDAY']
+
+    return text
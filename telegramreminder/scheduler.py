@@ -0,0 +1,192 @@
+import heapq
+import datetime
+import threading
+from . import db
+
+
+class ReminderScheduler:
+
+    def __init__(self, engine, job_queue, callback, resync_interval=300, preload=1000,
+                 shard_count=None, shard_index=None, error_delay=5):
+        self._engine = engine
+        self._job_queue = job_queue
+        self._callback = callback
+        self._resync_interval = datetime.timedelta(seconds=resync_interval)
+        self._preload = preload
+        self._error_delay = datetime.timedelta(seconds=error_delay)
+        self._shard_count = shard_count
+        self._shard_index = shard_index
+
+        self._lock = threading.RLock()
+        self._heap = []
+        self._entries = {}
+        # datetime of the last preloaded reminder when the preload was cut off,
+        # reminders after it are picked up by the next resync
+        self._horizon = None
+        self._synced_at = None
+
+        self._job = None
+        self._wake_time = None
+        # set when the last callback left due reminders behind
+        self._backlog = False
+        # the callback is also run at this time, without due reminders
+        self._retry_time = None
+        # other processes do not notify this one, the database is checked this often
+        self._probe_interval = None
+        self._probed_at = None
+
+    def start(self):
+        with self._lock:
+            db.reminder_listeners.append(self._on_reminder_changed)
+            self._resync()
+            self._reschedule()
+
+    def stop(self):
+        db.reminder_listeners.remove(self._on_reminder_changed)
+
+        with self._lock:
+            if self._job is not None:
+                self._job.schedule_removal()
+                self._job = None
+
+    def set_probe_interval(self, seconds):
+        with self._lock:
+            self._probe_interval = datetime.timedelta(seconds=seconds)
+            self._probed_at = datetime.datetime.utcnow()
+            self._reschedule()
+
+    def _probe(self, now):
+        # a reminder earlier than the heap knows of was added by another process
+        self._probed_at = now
+        earliest = db.Reminder.get_earliest(self._engine, self._shard_count, self._shard_index)
+        if earliest is None:
+            return
+
+        next_due = self._peek()
+        if next_due is None or earliest < next_due:
+            self._resync()
+
+    def _resync(self):
+        schedule = db.Reminder.get_schedule(
+            self._engine, self._preload, self._shard_count, self._shard_index)
+
+        self._entries = {reminder_id: when for reminder_id, when in schedule}
+        self._heap = [(when, reminder_id) for reminder_id, when in schedule]
+        heapq.heapify(self._heap)
+
+        if len(schedule) >= self._preload:
+            self._horizon = schedule[-1][1]
+        else:
+            self._horizon = None
+
+        self._synced_at = datetime.datetime.utcnow()
+
+    def _on_reminder_changed(self, engine, reminder_id, when):
+        if engine is self._engine:
+            self.push(reminder_id, when)
+
+    def push(self, reminder_id, when):
+        with self._lock:
+            if when is None or (self._horizon is not None and when > self._horizon):
+                self._entries.pop(reminder_id, None)
+                return
+
+            self._entries[reminder_id] = when
+            heapq.heappush(self._heap, (when, reminder_id))
+
+            if self._wake_time is None or when < self._wake_time:
+                self._reschedule()
+
+    def wake_at(self, when):
+        with self._lock:
+            if self._retry_time is not None and self._retry_time <= when:
+                return
+
+            self._retry_time = when
+            if self._wake_time is None or when < self._wake_time:
+                self._reschedule()
+
+    def _peek(self):
+        # entries are removed lazily: a heap item is stale once the reminder
+        # was deleted or moved to another time
+        while self._heap:
+            when, reminder_id = self._heap[0]
+            if self._entries.get(reminder_id) == when:
+                return when
+            heapq.heappop(self._heap)
+
+        return None
+
+    def _pop_due(self, now):
+        due = []
+        when = self._peek()
+        while when is not None and when < now:
+            _, reminder_id = heapq.heappop(self._heap)
+            del self._entries[reminder_id]
+            due.append(reminder_id)
+            when = self._peek()
+
+        return due
+
+    def _reschedule(self, wake_time=None):
+        if wake_time is None:
+            wake_time = self._synced_at + self._resync_interval
+
+            next_due = self._peek()
+            if next_due is not None:
+                wake_time = min(wake_time, next_due)
+            if self._retry_time is not None:
+                wake_time = min(wake_time, self._retry_time)
+            if self._probe_interval is not None:
+                wake_time = min(wake_time, self._probed_at + self._probe_interval)
+
+        if self._job is not None:
+            if wake_time == self._wake_time:
+                return
+            self._job.schedule_removal()
+
+        delay = (wake_time - datetime.datetime.utcnow()).total_seconds()
+
+        self._wake_time = wake_time
+        self._job = self._job_queue.run_once(self._wake, max(delay, 0))
+
+    def _wake(self, bot, job):
+        with self._lock:
+            if job is not self._job:
+                return
+
+            self._job = None
+            self._wake_time = None
+
+            now = datetime.datetime.utcnow()
+            if now >= self._synced_at + self._resync_interval:
+                self._resync()
+            elif self._probe_interval is not None and now >= self._probed_at + self._probe_interval:
+                self._probe(now)
+
+            due = self._pop_due(now)
+
+            retry = self._retry_time is not None and self._retry_time <= now
+            if retry:
+                self._retry_time = None
+
+        more = False
+        failed = True
+        try:
+            if due or retry or self._backlog:
+                more = self._callback(bot, job)
+            failed = False
+        finally:
+            with self._lock:
+                # the due reminders are off the heap, after an error they are
+                # picked up as a backlog
+                self._backlog = bool(more) or failed
+                if self._peek() is None and self._horizon is not None:
+                    self._resync()
+
+                if failed:
+                    self._reschedule(datetime.datetime.utcnow() + self._error_delay)
+                elif more:
+                    self._reschedule(datetime.datetime.utcnow())
+                else:
+                    self._reschedule()
@@ -1,14 +1,23 @@
 import datetime
 import calendar
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from .language import translate
+import functools
+import threading
+from telegram import InlineKeyboardButton
+from .keyboards import FrozenInlineKeyboardMarkup
+from .language import translate, translate_list
 
 
 def create_callback_data(action, year=0, month=0, day=0):
     return ";".join([action, str(year), str(month), str(day)])
 
 
+_calendar_date = None
+_calendar_lock = threading.Lock()
+
+
 def create_calendar(lang, year=None, month=None):
+    global _calendar_date
+
     now = datetime.datetime.now()
 
     if year is None:
@@ -16,19 +25,28 @@ def create_calendar(lang, year=None, month=None):
     if month is None:
         month = now.month
 
-    curr_month = False
-    if year == now.year and month == now.month:
-        curr_month = True
+    # days before today are hidden in the current month, the cache is dropped at midnight
+    today = now.date()
+    if _calendar_date != today:
+        with _calendar_lock:
+            if _calendar_date != today:
+                build_calendar.cache_clear()
+                _calendar_date = today
+
+    cutoff = now.day if year == now.year and month == now.month else 0
+
+    return build_calendar(lang, year, month, cutoff)
 
-    now_day = now.day
 
+@functools.lru_cache(maxsize=256)
+def build_calendar(lang, year, month, cutoff):
     ignore_callback = create_callback_data(action="IGNORE")
 
     keyboard = []
     
     # month and year
     row = []
-    month_name = translate('Months', lang).split(',')[month-1]
+    month_name = translate_list('Months', lang)[month-1]
 
     row.append(InlineKeyboardButton(month_name + " " + str(year),
                callback_data=ignore_callback))
@@ -36,7 +54,7 @@ def create_calendar(lang, year=None, month=None):
 
     # week days
     row = []
-    for day in translate('WeekDays', lang).split(','):
+    for day in translate_list('WeekDays', lang):
         row.append(InlineKeyboardButton(day, callback_data=ignore_callback))
     keyboard.append(row)
 
@@ -45,7 +63,7 @@ def create_calendar(lang, year=None, month=None):
         row = []
         week_has_day = False
         for day in week:
-            if (curr_month and day < now_day) or day == 0:
+            if day < cutoff or day == 0:
                 row.append(InlineKeyboardButton(" ", callback_data=ignore_callback))
             else:
                 week_has_day = True
@@ -81,7 +99,7 @@ def create_calendar(lang, year=None, month=None):
 
     keyboard.append(row)
 
-    return InlineKeyboardMarkup(keyboard)
+    return FrozenInlineKeyboardMarkup(keyboard)
 
 
 def process_selection(bot, update, lang):
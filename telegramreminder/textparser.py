@@ -0,0 +1,226 @@
+import datetime
+from collections import namedtuple
+from dateutil.relativedelta import relativedelta
+from . import recurrence
+
+
+NO_TIME = 'NO_TIME'
+BAD_TIME = 'BAD_TIME'
+BAD_DATE = 'BAD_DATE'
+NO_TEXT = 'NO_TEXT'
+EXTRA_TEXT = 'EXTRA_TEXT'
+
+ParseResult = namedtuple('ParseResult', 'date frequency text error')
+
+
+class ParseError(ValueError):
+
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+
+
+class Vocabulary:
+
+    def __init__(self, time_markers, date_prepositions, relative_days, weekdays, months, frequencies,
+                 every=(), periods=(), ordinals=()):
+        self.time_markers = frozenset(time_markers)
+        self.date_prepositions = frozenset(date_prepositions)
+        self.relative_days = dict(relative_days)
+        self.weekdays = {word: weekday for weekday, words in enumerate(weekdays)
+                         for word in words}
+        self.months = {word: month for month, words in enumerate(months, 1)
+                       for word in words}
+        self.frequencies = dict(frequencies)
+        # "every 2 weeks", "every monday,friday", "every last friday"
+        self.every = frozenset(every)
+        self.periods = {word: period for period, words in periods for word in words}
+        self.ordinals = dict(ordinals)
+
+
+vocabularies = {}
+
+
+def register_vocabulary(language, vocabulary):
+    vocabularies[language] = vocabulary
+
+
+register_vocabulary('RUS', Vocabulary(
+    time_markers=('в', 'во'),
+    date_prepositions=('в', 'во'),
+    relative_days={'сегодня': 0, 'завтра': 1, 'послезавтра': 2},
+    weekdays=(('понедельник', 'пн'), ('вторник', 'вт'), ('среда', 'среду', 'ср'),
+              ('четверг', 'чт'), ('пятница', 'пятницу', 'пт'), ('суббота', 'субботу', 'сб'),
+              ('воскресенье', 'вс')),
+    months=(('января',), ('февраля',), ('марта',), ('апреля',), ('мая',), ('июня',),
+            ('июля',), ('августа',), ('сентября',), ('октября',), ('ноября',), ('декабря',)),
+    frequencies={'ежедневно': 'DAY', 'еженедельно': 'WEEK', 'ежемесячно': 'MONTH'},
+    every=('каждый', 'каждую', 'каждое', 'каждые'),
+    periods=(('DAILY', ('день', 'дня', 'дней')), ('WEEKLY', ('неделю', 'недели', 'недель')),
+             ('MONTHLY', ('месяц', 'месяца', 'месяцев')), ('YEARLY', ('год', 'года', 'лет'))),
+    ordinals={'первый': 1, 'первую': 1, 'первое': 1, 'второй': 2, 'вторую': 2, 'второе': 2,
+              'третий': 3, 'третью': 3, 'третье': 3, 'четвертый': 4, 'четвертую': 4,
+              'четвертое': 4, 'последний': -1, 'последнюю': -1, 'последнее': -1},
+))
+
+register_vocabulary('ENG', Vocabulary(
+    time_markers=('at',),
+    date_prepositions=('on',),
+    relative_days={'today': 0, 'tomorrow': 1},
+    weekdays=(('monday', 'mon'), ('tuesday', 'tue'), ('wednesday', 'wed'), ('thursday', 'thu'),
+              ('friday', 'fri'), ('saturday', 'sat'), ('sunday', 'sun')),
+    months=(('january', 'jan'), ('february', 'feb'), ('march', 'mar'), ('april', 'apr'),
+            ('may',), ('june', 'jun'), ('july', 'jul'), ('august', 'aug'),
+            ('september', 'sep'), ('october', 'oct'), ('november', 'nov'), ('december', 'dec')),
+    frequencies={'daily': 'DAY', 'weekly': 'WEEK', 'monthly': 'MONTH'},
+    every=('every',),
+    periods=(('DAILY', ('day', 'days')), ('WEEKLY', ('week', 'weeks')),
+             ('MONTHLY', ('month', 'months')), ('YEARLY', ('year', 'years'))),
+    ordinals={'first': 1, '1st': 1, 'second': 2, '2nd': 2, 'third': 3, '3rd': 3,
+              'fourth': 4, '4th': 4, 'last': -1},
+))
+
+
+def parse_reminder(text, now, languages=None, only_datetime=False):
+    # text is "<title> [date] <time marker> <time> [frequency]", now is the local time
+    tokens = text.split()
+    words = [token.lower() for token in tokens]
+
+    if languages is None:
+        languages = vocabularies.keys()
+    else:
+        languages = [language for language in languages if language in vocabularies]
+
+    result = ParseResult(None, None, None, NO_TIME)
+    for language in languages:
+        language_result = parse_tokens(
+            tokens, words, now, vocabularies[language], only_datetime)
+        if language_result.error is None:
+            return language_result
+        if result.error == NO_TIME:
+            result = language_result
+
+    return result
+
+
+def parse_tokens(tokens, words, now, vocabulary, only_datetime=False):
+    end = len(words)
+
+    frequency, end = parse_frequency(words, end, vocabulary)
+
+    marker = end - 1
+    while marker >= 0 and words[marker] not in vocabulary.time_markers:
+        marker -= 1
+    if marker < 0:
+        return ParseResult(None, None, None, NO_TIME)
+
+    time = parse_time(words[marker + 1:end])
+    if time is None:
+        return ParseResult(None, None, None, BAD_TIME)
+    end = marker
+
+    today = datetime.datetime(now.year, now.month, now.day)
+    last = words[end - 1] if end else None
+
+    dated = True
+    try:
+        if last in vocabulary.relative_days:
+            date = today + relativedelta(days=vocabulary.relative_days[last])
+            end -= 1
+        elif last in vocabulary.weekdays:
+            days = (vocabulary.weekdays[last] - now.weekday()) % 7
+            date = today + relativedelta(days=days)
+            end -= 1
+        elif last in vocabulary.months and end >= 2 and words[end - 2].isdecimal():
+            month = vocabulary.months[last]
+            year = now.year + 1 if month < now.month else now.year
+            date = datetime.datetime(year, month, int(words[end - 2]))
+            end -= 2
+        elif last is not None and last.isdecimal() and end >= 2 and words[end - 2] in vocabulary.months:
+            month = vocabulary.months[words[end - 2]]
+            year = now.year + 1 if month < now.month else now.year
+            date = datetime.datetime(year, month, int(last))
+            end -= 2
+        elif last is not None and len(last) <= 2 and last.isdecimal():
+            date = datetime.datetime(now.year, now.month, int(last))
+            end -= 1
+        else:
+            date = today
+            dated = False
+    except ValueError:
+        return ParseResult(None, None, None, BAD_DATE)
+
+    if dated and end and words[end - 1] in vocabulary.date_prepositions:
+        end -= 1
+
+    text = ' '.join(tokens[:end])
+    if only_datetime and text:
+        return ParseResult(None, None, None, EXTRA_TEXT)
+    if not only_datetime and not text:
+        return ParseResult(None, None, None, NO_TEXT)
+
+    date = date + time
+    if frequency is not None:
+        date = recurrence.get_first_datetime(date, frequency)
+
+    return ParseResult(date, frequency, text, None)
+
+
+def parse_frequency(words, end, vocabulary):
+    # the frequency and the end of the words before it
+    if end and words[end - 1] in vocabulary.frequencies:
+        return vocabulary.frequencies[words[end - 1]], end - 1
+
+    for start in (end - 2, end - 3):
+        if start >= 0 and words[start] in vocabulary.every:
+            frequency = parse_every(words[start + 1:end], vocabulary)
+            if frequency is not None:
+                return frequency, start
+
+    return None, end
+
+
+def parse_every(words, vocabulary):
+    if len(words) == 1:
+        if words[0] in vocabulary.periods:
+            return recurrence.make_rule(vocabulary.periods[words[0]])
+
+        weekdays = words[0].split(',')
+        if all(weekday in vocabulary.weekdays for weekday in weekdays):
+            byday = []
+            for weekday in weekdays:
+                day = recurrence.WEEKDAYS[vocabulary.weekdays[weekday]]
+                if day not in byday:
+                    byday.append(day)
+            return recurrence.make_rule('WEEKLY', byday=byday)
+
+    elif len(words) == 2:
+        number, word = words
+        if number.isdecimal() and 0 < int(number) <= 1000 and word in vocabulary.periods:
+            return recurrence.make_rule(vocabulary.periods[word], int(number))
+
+        if number in vocabulary.ordinals and word in vocabulary.weekdays:
+            day = recurrence.WEEKDAYS[vocabulary.weekdays[word]]
+            return recurrence.make_rule('MONTHLY', byday=[f'{vocabulary.ordinals[number]}{day}'])
+
+    return None
+
+
+def parse_time(words):
+    if not 1 <= len(words) <= 2:
+        return None
+
+    if len(words) == 1:
+        words = words[0].split(':')
+        if len(words) > 2:
+            return None
+
+    if not all(word.isdecimal() for word in words):
+        return None
+
+    hours = int(words[0])
+    minutes = int(words[1]) if len(words) > 1 else 0
+    if hours > 23 or minutes > 59:
+        return None
+
+    return datetime.timedelta(hours=hours, minutes=minutes)
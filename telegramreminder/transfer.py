@@ -0,0 +1,248 @@
+import sys
+import csv
+import json
+import argparse
+import datetime
+from collections import namedtuple
+from . import db
+from . import recurrence
+
+
+FIELDS = ('chat_id', 'text', 'date', 'time', 'frequency', 'timezone')
+
+ImportResult = namedtuple('ImportResult', 'imported errors')
+
+
+class RowError(ValueError):
+    pass
+
+
+def read_rows(f, format):
+    # rows that cannot be read are yielded as RowError, they are reported like invalid rows
+    if format == 'csv':
+        reader = csv.DictReader(f)
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                yield RowError(f'bad csv: {e}')
+                continue
+
+            if None in row:
+                yield RowError('too many fields')
+            else:
+                yield row
+    else:
+        for line in f:
+            if not line.strip():
+                continue
+
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield RowError(f'bad json: {e}')
+                continue
+
+            if not isinstance(row, dict):
+                yield RowError('not an object')
+            else:
+                yield row
+
+
+def write_rows(f, rows, format):
+    if format == 'csv':
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+
+def get_format(path, format=None):
+    if format is not None:
+        return format
+    return 'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv'
+
+
+def _load_chat_settings(engine, chat_ids, settings):
+    # settings of a whole chunk in one query, the settings cache is bypassed
+    chat_ids = [chat_id for chat_id in chat_ids if chat_id not in settings]
+    # chats without settings are not queried again
+    settings.update((chat_id, (None, None)) for chat_id in chat_ids)
+
+    session = db.get_session(engine)
+    # sqlite limits the number of bound parameters
+    for start in range(0, len(chat_ids), 900):
+        rows = session.query(db.UserSettings.chat_id, db.UserSettings.language,
+                             db.UserSettings.timezone).filter(
+            db.UserSettings.chat_id.in_(chat_ids[start:start + 900])).all()
+        settings.update((row.chat_id, (row.language, row.timezone)) for row in rows)
+    session.close()
+
+
+def _to_mapping(row, settings):
+    # row values are local times of the chat, they are stored in UTC
+    if isinstance(row, RowError):
+        raise row
+
+    try:
+        chat_id = int(row['chat_id'])
+    except (KeyError, TypeError, ValueError):
+        raise RowError('bad chat_id')
+
+    text = (row.get('text') or '').strip()
+    frequency = row.get('frequency') or None
+    if frequency is not None and not recurrence.is_valid(frequency):
+        raise RowError(f'bad frequency {frequency}')
+
+    language, timezone = settings.get(chat_id, (None, None))
+    timezone = row.get('timezone') or timezone or db.UserSettings.get_default_settings('timezone')
+    language = language or db.UserSettings.get_default_settings('language')
+    try:
+        db.get_timezone(timezone)
+    except Exception:
+        raise RowError(f'bad timezone {timezone}')
+
+    if row.get('date') or row.get('time'):
+        try:
+            date = datetime.datetime.combine(
+                datetime.date.fromisoformat(row.get('date') or ''), datetime.time())
+        except ValueError:
+            raise RowError('bad date')
+        time = db.process_time(row.get('time') or '')
+        if time is None:
+            raise RowError('bad time')
+        local_datetime = date + time
+        if frequency is not None:
+            # as in a chat message, "every monday" starts on a monday
+            local_datetime = recurrence.get_first_datetime(local_datetime, frequency)
+            if local_datetime is None:
+                raise RowError('schedule has ended')
+    else:
+        # the date and time are a part of the text, as in a chat message
+        result = db.UserInput.parse_reminder_str(text, timezone, language)
+        if result.error is not None:
+            raise RowError(result.error)
+        local_datetime, text = result.date, result.text
+        frequency = frequency or result.frequency
+
+    if not text:
+        raise RowError('empty text')
+
+    return {'chat_id': chat_id, 'text': text, 'frequency': frequency,
+            'datetime': db.get_utc_time(local_datetime, timezone)}
+
+
+def _import_chunk(engine, rows, settings, errors):
+    chat_ids = set()
+    for line, row in rows:
+        try:
+            chat_ids.add(int(row['chat_id']))
+        except (KeyError, TypeError, ValueError):
+            pass
+    _load_chat_settings(engine, chat_ids, settings)
+
+    mappings = []
+    for line, row in rows:
+        try:
+            mappings.append(_to_mapping(row, settings))
+        except RowError as e:
+            errors.append((line, str(e)))
+
+    if mappings:
+        # one executemany, every mapping has the same keys
+        session = db.get_session(engine)
+        session.execute(db.Reminder.__table__.insert(), mappings)
+        db.session_commit(session)
+
+    return len(mappings)
+
+
+def import_reminders(engine, rows, chunk_size=5000):
+    # invalid rows are skipped and reported with their 1-based position
+    imported = 0
+    errors = []
+    settings = {}
+
+    chunk = []
+    for line, row in enumerate(rows, 1):
+        chunk.append((line, row))
+        if len(chunk) >= chunk_size:
+            imported += _import_chunk(engine, chunk, settings, errors)
+            chunk = []
+    if chunk:
+        imported += _import_chunk(engine, chunk, settings, errors)
+
+    return ImportResult(imported, errors)
+
+
+def export_reminders(engine, chunk_size=5000, chat_id=None):
+    # keyset on the id, every chunk is a separate short query
+    default_timezone = db.UserSettings.get_default_settings('timezone')
+
+    last_id = 0
+    while True:
+        session = db.get_session(engine)
+        query = session.query(
+            db.Reminder.id, db.Reminder.chat_id, db.Reminder.text, db.Reminder.datetime,
+            db.Reminder.frequency, db.UserSettings.timezone).outerjoin(
+            db.UserSettings, db.UserSettings.chat_id == db.Reminder.chat_id).filter(
+            db.Reminder.id > last_id)
+        if chat_id is not None:
+            query = query.filter(db.Reminder.chat_id == chat_id)
+        rows = query.order_by(db.Reminder.id).limit(chunk_size).all()
+        session.close()
+
+        for row in rows:
+            timezone = row.timezone or default_timezone
+            local_datetime = db.get_local_time(row.datetime, timezone)
+            yield {'chat_id': row.chat_id, 'text': row.text,
+                   'date': local_datetime.strftime('%Y-%m-%d'),
+                   'time': local_datetime.strftime('%H:%M'),
+                   'frequency': row.frequency or '', 'timezone': timezone}
+
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1].id
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import and export reminders')
+    parser.add_argument('action', choices=('import', 'export'))
+    parser.add_argument('db_url', help='for example sqlite:///BASE.db')
+    parser.add_argument('path', help='csv or jsonl file, - for stdin or stdout')
+    parser.add_argument('--format', choices=('csv', 'jsonl'))
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--chat-id', type=int, help='export one chat only')
+    args = parser.parse_args(argv)
+
+    format = get_format(args.path, args.format)
+    engine = db.open_database(args.db_url)
+
+    if args.action == 'export':
+        rows = export_reminders(engine, args.chunk_size, args.chat_id)
+        if args.path == '-':
+            write_rows(sys.stdout, rows, format)
+        else:
+            with open(args.path, 'w', encoding='utf-8', newline='') as f:
+                write_rows(f, rows, format)
+        return 0
+
+    if args.path == '-':
+        result = import_reminders(engine, read_rows(sys.stdin, format), args.chunk_size)
+    else:
+        with open(args.path, encoding='utf-8', newline='') as f:
+            result = import_reminders(engine, read_rows(f, format), args.chunk_size)
+
+    for line, error in result.errors:
+        print(f'row {line}: {error}', file=sys.stderr)
+    print(f'imported {result.imported}, skipped {len(result.errors)}', file=sys.stderr)
+
+    return 1 if result.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
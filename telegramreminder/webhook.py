@@ -0,0 +1,143 @@
+import json
+import queue
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telegram import Update
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+updates_received = metrics.registry.counter(
+    'telegramreminder_webhook_updates_total', 'Webhook updates by result', ('result',))
+
+
+class UpdateQueue:
+
+    # updates of one chat always go to the same worker, so they are handled in order
+    def __init__(self, dispatcher, workers=8, maxsize=1000):
+        self._dispatcher = dispatcher
+        self._queues = [queue.Queue(maxsize=max(1, maxsize // workers)) for _ in range(workers)]
+        self._threads = []
+
+    def start(self):
+        for i, partition in enumerate(self._queues):
+            thread = threading.Thread(target=self._work, args=(partition,),
+                                      name=f'update-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for partition in self._queues:
+            partition.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    @staticmethod
+    def get_partition_key(update):
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return update.update_id
+
+    def put(self, update):
+        # False when the partition is full, the update should be retried later
+        partition = self._queues[hash(self.get_partition_key(update)) % len(self._queues)]
+        try:
+            partition.put_nowait(update)
+        except queue.Full:
+            return False
+
+        return True
+
+    def _work(self, partition):
+        while True:
+            update = partition.get()
+            if update is None:
+                return
+
+            try:
+                self._dispatcher.process_update(update)
+            except Exception:
+                logger.exception('Update %s failed', update.update_id)
+
+
+class _HTTPServer(ThreadingHTTPServer):
+
+    # telegram opens up to 40 connections at once, the default backlog is 5
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class WebhookServer:
+
+    def __init__(self, bot, update_queue, listen='0.0.0.0', port=8443, url_path='/', retry_after=1):
+        self._bot = bot
+        self._update_queue = update_queue
+        self._url_path = url_path
+        self._retry_after = retry_after
+
+        self._server = _HTTPServer((listen, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def server_address(self):
+        return self._server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='webhook')
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def _handle(self, path, body):
+        if path != self._url_path:
+            return 404, {}
+
+        try:
+            update = Update.de_json(json.loads(body), self._bot)
+        except (ValueError, KeyError, TypeError):
+            updates_received.inc(result='invalid')
+            return 400, {}
+
+        if update is None:
+            updates_received.inc(result='invalid')
+            return 400, {}
+
+        if not self._update_queue.put(update):
+            # telegram delivers the update again later
+            updates_received.inc(result='rejected')
+            return 503, {'Retry-After': str(self._retry_after)}
+
+        updates_received.inc(result='queued')
+        return 200, {}
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+
+                status, headers = server._handle(self.path, body)
+
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,65 @@
+import pytest
+
+from telegramreminder import db
+from telegramreminder.bot import TelegramReminder
+from telegramreminder.delivery import DeliveryPool
+from telegramreminder.scheduler import ReminderScheduler
+
+
+class FakeJob:
+
+    def __init__(self, callback, delay):
+        self.callback = callback
+        self.delay = delay
+        self.removed = False
+
+    def schedule_removal(self):
+        self.removed = True
+
+
+class FakeJobQueue:
+
+    def __init__(self):
+        self.jobs = []
+
+    def run_once(self, callback, delay):
+        job = FakeJob(callback, delay)
+        self.jobs.append(job)
+        return job
+
+    @property
+    def job(self):
+        jobs = [job for job in self.jobs if not job.removed]
+        assert len(jobs) == 1
+        return jobs[0]
+
+    def run(self, bot=None):
+        job = self.job
+        job.removed = True
+        job.callback(bot, job)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = db.open_database(f'sqlite:///{tmp_path / "test.db"}')
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def job_queue():
+    return FakeJobQueue()
+
+
+@pytest.fixture
+def reminder_bot(tmp_path, job_queue):
+    bot = TelegramReminder('123456:TEST', db_url=f'sqlite:///{tmp_path / "bot.db"}', retry_delay=30)
+    bot.reminder_scheduler.stop()
+    bot.delivery.shutdown()
+    bot.delivery = DeliveryPool(workers=2, global_rate=10 ** 9, chat_rate=10 ** 9, max_retries=0)
+    bot.reminder_scheduler = ReminderScheduler(bot.db_engine, job_queue, bot._send_reminders)
+    bot.reminder_scheduler.start()
+    yield bot
+    bot.reminder_scheduler.stop()
+    bot.delivery.shutdown()
+    bot.db_engine.dispose()
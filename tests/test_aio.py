@@ -0,0 +1,95 @@
+import asyncio
+import datetime
+
+import pytest
+
+from telegramreminder import aio, db
+
+
+@pytest.fixture
+def database(engine):
+    database = aio.AsyncDatabase(engine, workers=2)
+    yield database
+    database.close()
+
+
+def add_reminder(engine, chat_id, when, frequency=None):
+    session = db.get_session(engine)
+    reminder = db.Reminder(chat_id, 'tea', when, frequency)
+    session.add(reminder)
+    session.flush()
+    reminder_id = reminder.id
+    db.session_commit(session)
+
+    return reminder_id
+
+
+def test_settings_are_awaited(database):
+    async def main():
+        await database.UserSettings.set_user_settings(1, language='ENG', timezone='Etc/GMT-3')
+        return await database.UserSettings.get_user_settings(1, 'timezone')
+
+    assert asyncio.run(main()) == 'Etc/GMT-3'
+    assert db.UserSettings.get_user_settings(database.engine, 1, 'language') == 'ENG'
+
+
+def test_generators_are_collected(database):
+    due = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+    add_reminder(database.engine, 1, due)
+    add_reminder(database.engine, 2, due)
+
+    reminders = asyncio.run(database.Reminder.get_reminders())
+    assert [reminder.chat_id for reminder in reminders] == [1, 2]
+
+
+def test_methods_take_the_engine_of_the_database(database):
+    reminder_id = add_reminder(database.engine, 1, datetime.datetime(2026, 10, 14, 9), 'DAY')
+
+    async def main():
+        await database.Reminder.move_reccuring_reminder(reminder_id)
+        reminder = await database.Reminder.get_reminder(reminder_id)
+        await database.Reminder.delete_reminder(reminder_id)
+        return reminder, await database.Reminder.get_reminder(reminder_id)
+
+    moved, deleted = asyncio.run(main())
+    assert moved.datetime == datetime.datetime(2026, 10, 15, 9)
+    assert deleted is None
+
+
+def test_outbox_is_awaited(database):
+    add_reminder(database.engine, 1, datetime.datetime.utcnow() - datetime.timedelta(minutes=1))
+
+    async def main():
+        assert await database.Delivery.stage_due_reminders() == 1
+        claimed = await database.Delivery.claim_pending('a')
+        await database.Delivery.record_results(claimed, {claimed[0].id: db.DELIVERY_SENT}, 'a')
+        return await database.Delivery.get_next_attempt()
+
+    assert asyncio.run(main()) is None
+
+
+def test_helpers_stay_synchronous(database):
+    assert database.UserSettings.get_default_settings('language') == \
+        db.UserSettings.get_default_settings('language')
+    assert database.Reminder.get_next_datetime(datetime.datetime(2026, 10, 14, 9), 'DAY') == \
+        datetime.datetime(2026, 10, 15, 9)
+
+
+@pytest.mark.parametrize('model, name', [
+    ('Reminder', 'query'),
+    ('Reminder', '__tablename__'),
+    ('Reminder', '_query_due'),
+    ('Delivery', 'metadata'),
+    ('UserSettings', 'set_timezone'),
+])
+def test_unlisted_names_are_not_available(database, model, name):
+    with pytest.raises(AttributeError, match='not available in AsyncDatabase'):
+        getattr(getattr(database, model), name)
+
+
+def test_deliver_runs_the_pool_off_the_loop():
+    class Pool:
+        def deliver(self, bot, messages):
+            return {message: bot for message in messages}
+
+    assert asyncio.run(aio.deliver(Pool(), 'bot', ['a', 'b'])) == {'a': 'bot', 'b': 'bot'}
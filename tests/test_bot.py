@@ -0,0 +1,68 @@
+import datetime
+
+import pytest
+
+from telegramreminder import db
+from telegramreminder.delivery import DeliveryPool
+
+
+class RecordingBot:
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text, reply_markup=None):
+        self.sent.append((chat_id, text))
+
+
+@pytest.fixture
+def digest_bot(reminder_bot):
+    # five messages per chat fit in half of the lease
+    reminder_bot.delivery.shutdown()
+    reminder_bot.delivery = DeliveryPool(workers=2, global_rate=10 ** 9, chat_rate=10)
+    reminder_bot._lease = 1
+    reminder_bot._digest_threshold = 8
+    return reminder_bot
+
+
+def add_due_reminders(engine, chat_id, count, text='tea'):
+    due = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+    session = db.get_session(engine)
+    for i in range(count):
+        session.add(db.Reminder(chat_id, f'{text} {i}', due, None))
+    db.session_commit(session)
+
+
+def get_statuses(engine, chat_id):
+    session = db.get_session(engine)
+    rows = session.query(db.Delivery.status, db.Delivery.attempts, db.Delivery.claimed_by).filter(
+        db.Delivery.chat_id == chat_id).all()
+    session.close()
+
+    return rows
+
+
+def test_chats_without_a_digest_get_their_quota(digest_bot):
+    bot = RecordingBot()
+    add_due_reminders(digest_bot.db_engine, 1, 7)
+    add_due_reminders(digest_bot.db_engine, 2, 12)
+
+    assert digest_bot._send_due_reminders(bot) is True
+    assert [chat_id for chat_id, _ in bot.sent].count(1) == 5
+    assert [chat_id for chat_id, _ in bot.sent].count(2) == 1
+    assert get_statuses(digest_bot.db_engine, 1).count((db.DELIVERY_PENDING, 0, None)) == 2
+
+    bot.sent = []
+    assert digest_bot._send_due_reminders(bot) is False
+    assert [chat_id for chat_id, _ in bot.sent] == [1, 1]
+    assert {status for status, _, _ in get_statuses(digest_bot.db_engine, 1)} == {db.DELIVERY_SENT}
+
+
+def test_long_digests_get_the_quota(digest_bot):
+    # every digest holds a single reminder of this length
+    bot = RecordingBot()
+    add_due_reminders(digest_bot.db_engine, 1, 8, 'tea' * 1000)
+
+    assert digest_bot._send_due_reminders(bot) is True
+    assert len(bot.sent) == 5
+    assert get_statuses(digest_bot.db_engine, 1).count((db.DELIVERY_PENDING, 0, None)) == 3
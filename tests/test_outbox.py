@@ -0,0 +1,173 @@
+import datetime
+
+import pytest
+
+from telegramreminder import db
+
+
+def add_due_reminders(engine, chat_ids, frequency=None):
+    due = datetime.datetime.utcnow().replace(microsecond=0) - datetime.timedelta(minutes=1)
+    session = db.get_session(engine)
+    for chat_id in chat_ids:
+        session.add(db.Reminder(chat_id, f'tea {chat_id}', due, frequency))
+    db.session_commit(session)
+
+
+def get_deliveries(engine):
+    session = db.get_session(engine)
+    deliveries = session.query(db.Delivery).order_by(db.Delivery.id).all()
+    session.close()
+
+    return deliveries
+
+
+def assert_close(when, expected):
+    assert abs((when - expected).total_seconds()) < 5
+
+
+def test_stage_moves_due_reminders_to_the_outbox(engine):
+    add_due_reminders(engine, [1])
+    add_due_reminders(engine, [2], 'DAY')
+
+    assert db.Delivery.stage_due_reminders(engine) == 2
+    assert db.Delivery.stage_due_reminders(engine) == 0
+
+    assert [reminder.chat_id for reminder in db.Reminder.get_reminders(engine, False)] == [2]
+    assert [(delivery.chat_id, delivery.status, delivery.attempts)
+            for delivery in get_deliveries(engine)] == [
+        (1, db.DELIVERY_PENDING, 0), (2, db.DELIVERY_PENDING, 0)]
+
+
+def test_stage_is_limited(engine):
+    add_due_reminders(engine, [1, 2, 3])
+
+    assert db.Delivery.stage_due_reminders(engine, limit=2) == 2
+    assert db.Delivery.stage_due_reminders(engine, limit=2) == 1
+
+
+def test_claimed_deliveries_are_leased(engine):
+    add_due_reminders(engine, [1, 2])
+    db.Delivery.stage_due_reminders(engine)
+
+    claimed = db.Delivery.claim_pending(engine, 'a')
+    assert [pending.chat_id for pending in claimed] == [1, 2]
+    assert db.Delivery.claim_pending(engine, 'b') == []
+
+
+def test_expired_lease_is_claimed_again(engine):
+    add_due_reminders(engine, [1])
+    db.Delivery.stage_due_reminders(engine)
+
+    assert len(db.Delivery.claim_pending(engine, 'a', lease=-1)) == 1
+    assert len(db.Delivery.claim_pending(engine, 'b')) == 1
+
+
+def test_claim_is_capped_per_chat(engine):
+    add_due_reminders(engine, [1, 1, 1, 2])
+    db.Delivery.stage_due_reminders(engine)
+
+    claimed = db.Delivery.claim_pending(engine, 'a', per_chat=2)
+    assert sorted(pending.chat_id for pending in claimed) == [1, 1, 2]
+    assert [pending.chat_id for pending in db.Delivery.claim_pending(engine, 'a')] == [1]
+
+
+def test_claim_is_limited_to_the_shard(engine):
+    add_due_reminders(engine, [1, 2, 3, 4])
+    db.Delivery.stage_due_reminders(engine)
+
+    first = db.Delivery.claim_pending(engine, 'a', shard_count=2, shard_index=0)
+    second = db.Delivery.claim_pending(engine, 'b', shard_count=2, shard_index=1)
+    assert sorted(pending.chat_id for pending in first + second) == [1, 2, 3, 4]
+    assert not {pending.chat_id for pending in first} & {pending.chat_id for pending in second}
+
+
+@pytest.mark.parametrize('status', [db.DELIVERY_SENT, db.DELIVERY_REJECTED])
+def test_results_finish_the_deliveries(engine, status):
+    add_due_reminders(engine, [1])
+    db.Delivery.stage_due_reminders(engine)
+    claimed = db.Delivery.claim_pending(engine, 'a')
+
+    db.Delivery.record_results(engine, claimed, {claimed[0].id: status}, 'a')
+
+    delivery, = get_deliveries(engine)
+    assert (delivery.status, delivery.attempts, delivery.claimed_by) == (status, 1, None)
+    assert delivery.finished_at is not None
+    assert db.Delivery.get_next_attempt(engine) is None
+
+
+def test_failed_deliveries_back_off(engine):
+    add_due_reminders(engine, [1])
+    db.Delivery.stage_due_reminders(engine)
+    now = datetime.datetime.utcnow()
+
+    claimed = db.Delivery.claim_pending(engine, 'a')
+    db.Delivery.record_results(engine, claimed, {claimed[0].id: db.DELIVERY_FAILED}, 'a')
+
+    delivery, = get_deliveries(engine)
+    assert (delivery.status, delivery.attempts, delivery.claimed_by) == (db.DELIVERY_PENDING, 1, None)
+    assert_close(delivery.next_attempt, now + datetime.timedelta(seconds=30))
+    assert db.Delivery.claim_pending(engine, 'a') == []
+    assert db.Delivery.get_next_attempt(engine) == delivery.next_attempt
+
+    # the second attempt waits twice as long
+    session = db.get_session(engine)
+    session.query(db.Delivery).update({'next_attempt': now})
+    db.session_commit(session)
+    claimed = db.Delivery.claim_pending(engine, 'a')
+    db.Delivery.record_results(engine, claimed, {}, 'a')
+
+    delivery, = get_deliveries(engine)
+    assert delivery.attempts == 2
+    assert_close(delivery.next_attempt, now + datetime.timedelta(seconds=60))
+
+
+def test_last_failed_attempt_finishes_the_delivery(engine):
+    add_due_reminders(engine, [1])
+    db.Delivery.stage_due_reminders(engine)
+
+    claimed = db.Delivery.claim_pending(engine, 'a')
+    db.Delivery.record_results(engine, claimed, {}, 'a', max_attempts=1)
+
+    delivery, = get_deliveries(engine)
+    assert delivery.status == db.DELIVERY_FAILED
+    assert db.Delivery.get_next_attempt(engine) is None
+
+
+def test_results_after_the_lease_are_dropped(engine):
+    add_due_reminders(engine, [1])
+    db.Delivery.stage_due_reminders(engine)
+
+    claimed = db.Delivery.claim_pending(engine, 'a', lease=-1)
+    db.Delivery.claim_pending(engine, 'b')
+    db.Delivery.record_results(engine, claimed, {claimed[0].id: db.DELIVERY_SENT}, 'a')
+
+    delivery, = get_deliveries(engine)
+    assert (delivery.status, delivery.claimed_by) == (db.DELIVERY_PENDING, 'b')
+
+
+def test_next_attempt_includes_the_leases(engine):
+    add_due_reminders(engine, [1, 2])
+    db.Delivery.stage_due_reminders(engine)
+    now = datetime.datetime.utcnow()
+
+    # the worker stops before recording the results
+    db.Delivery.claim_pending(engine, 'a', lease=60)
+    assert_close(db.Delivery.get_next_attempt(engine), now + datetime.timedelta(seconds=60))
+
+    # an earlier retry comes first
+    session = db.get_session(engine)
+    session.query(db.Delivery).filter(db.Delivery.chat_id == 1).update(
+        {'claimed_by': None, 'claimed_until': None,
+         'next_attempt': now + datetime.timedelta(seconds=30)})
+    db.session_commit(session)
+    assert_close(db.Delivery.get_next_attempt(engine), now + datetime.timedelta(seconds=30))
+
+
+def test_prune_keeps_pending_deliveries(engine):
+    add_due_reminders(engine, [1, 2])
+    db.Delivery.stage_due_reminders(engine)
+    claimed = db.Delivery.claim_pending(engine, 'a')
+    db.Delivery.record_results(engine, claimed, {claimed[0].id: db.DELIVERY_SENT}, 'a')
+
+    assert db.Delivery.prune(engine, datetime.datetime.utcnow() + datetime.timedelta(seconds=1)) == 1
+    assert [delivery.chat_id for delivery in get_deliveries(engine)] == [2]
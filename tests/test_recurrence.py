@@ -0,0 +1,149 @@
+import datetime
+import itertools
+
+import pytest
+
+from telegramreminder import db, recurrence
+
+
+D = datetime.datetime
+
+
+@pytest.mark.parametrize('start, frequency, after, expected', [
+    # fixed periods, at least one period ahead
+    (D(2026, 10, 14, 9), 'DAY', None, D(2026, 10, 15, 9)),
+    (D(2026, 12, 31, 9), 'DAY', None, D(2027, 1, 1, 9)),
+    (D(2026, 10, 14, 9), 'DAY', D(2026, 10, 20, 10), D(2026, 10, 21, 9)),
+    (D(2026, 10, 14, 9), 'WEEK', D(2026, 10, 20, 10), D(2026, 10, 21, 9)),
+    (D(2026, 10, 14, 9), 'WEEK', D(2026, 10, 21, 9), D(2026, 10, 28, 9)),
+    # month ends are clamped
+    (D(2026, 1, 31, 9), 'MONTH', None, D(2026, 2, 28, 9)),
+    (D(2028, 1, 31, 9), 'MONTH', None, D(2028, 2, 29, 9)),
+    (D(2026, 12, 15, 9), 'MONTH', None, D(2027, 1, 15, 9)),
+    (D(2026, 1, 31, 9), 'MONTH', D(2026, 3, 15), D(2026, 3, 31, 9)),
+    (D(2026, 1, 15, 9), 'MONTH', D(2026, 3, 15, 10), D(2026, 4, 15, 9)),
+    # weekdays wrap over the weekend
+    (D(2026, 10, 16, 9), 'WORKDAYS', None, D(2026, 10, 19, 9)),
+    (D(2026, 10, 14, 9), 'WORKDAYS', None, D(2026, 10, 15, 9)),
+    (D(2026, 10, 18, 9), 'WORKDAYS', None, D(2026, 10, 19, 9)),
+    (D(2026, 10, 14, 9), 'WORKDAYS', D(2026, 10, 23, 10), D(2026, 10, 26, 9)),
+    (D(2026, 10, 18, 9), 'WEEKENDS', None, D(2026, 10, 24, 9)),
+    (D(2026, 10, 17, 9), 'WEEKENDS', None, D(2026, 10, 18, 9)),
+    (D(2026, 12, 27, 9), 'WEEKENDS', None, D(2027, 1, 2, 9)),
+    # rules
+    (D(2026, 10, 14, 9), 'FREQ=DAILY;INTERVAL=3', None, D(2026, 10, 17, 9)),
+    (D(2026, 10, 14, 9), 'FREQ=DAILY;INTERVAL=3', D(2026, 10, 20, 10), D(2026, 10, 23, 9)),
+    (D(2026, 10, 16, 9), 'FREQ=WEEKLY;BYDAY=MO,FR', None, D(2026, 10, 19, 9)),
+    (D(2026, 10, 30, 9), 'FREQ=MONTHLY;BYDAY=-1FR', None, D(2026, 11, 27, 9)),
+    (D(2026, 12, 25, 9), 'FREQ=MONTHLY;BYDAY=-1FR', None, D(2027, 1, 29, 9)),
+    (D(2026, 10, 13, 9), 'FREQ=MONTHLY;BYDAY=2TU', None, D(2026, 11, 10, 9)),
+    # months without the day are skipped, not clamped
+    (D(2026, 1, 31, 9), 'FREQ=MONTHLY;BYMONTHDAY=31', None, D(2026, 3, 31, 9)),
+    (D(2028, 2, 29, 9), 'FREQ=YEARLY', None, D(2032, 2, 29, 9)),
+])
+def test_get_next_datetime(start, frequency, after, expected):
+    assert recurrence.get_next_datetime(start, frequency, after) == expected
+
+
+def test_occurrences_are_lazy_and_in_order():
+    occurrences = recurrence.occurrences(D(2026, 10, 16, 9), 'WORKDAYS')
+    assert list(itertools.islice(occurrences, 4)) == [
+        D(2026, 10, 19, 9), D(2026, 10, 20, 9), D(2026, 10, 21, 9), D(2026, 10, 22, 9)]
+
+
+def test_until_ends_the_rule():
+    frequency = 'FREQ=DAILY;UNTIL=20261016T235959'
+    assert list(recurrence.occurrences(D(2026, 10, 14, 9), frequency)) == [
+        D(2026, 10, 15, 9), D(2026, 10, 16, 9)]
+    assert recurrence.get_next_datetime(D(2026, 10, 16, 9), frequency) is None
+
+
+@pytest.mark.parametrize('start, frequency, expected', [
+    (D(2026, 10, 14, 9), 'DAY', D(2026, 10, 14, 9)),
+    (D(2026, 10, 14, 9), 'WEEKENDS', D(2026, 10, 17, 9)),
+    (D(2026, 10, 17, 9), 'WORKDAYS', D(2026, 10, 19, 9)),
+    (D(2026, 10, 14, 9), 'FREQ=WEEKLY;BYDAY=MO', D(2026, 10, 19, 9)),
+    (D(2026, 10, 19, 9), 'FREQ=WEEKLY;BYDAY=MO', D(2026, 10, 19, 9)),
+    (D(2026, 10, 14, 9), 'FREQ=DAILY;UNTIL=20261001', None),
+])
+def test_get_first_datetime(start, frequency, expected):
+    assert recurrence.get_first_datetime(start, frequency) == expected
+
+
+@pytest.mark.parametrize('frequency, valid', [
+    ('WEEKENDS', True),
+    ('FREQ=MONTHLY;BYDAY=2TU', True),
+    ('FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,WE', True),
+    ('FREQ=DAILY;UNTIL=20261231', True),
+    ('FREQ=DAILY;INTERVAL=0', False),
+    ('FREQ=HOURLY', False),
+    ('FREQ=DAILY;COUNT=3', False),
+    ('FREQ=DAILY;BYDAY=XX', False),
+    ('FREQ=DAILY;FREQ=WEEKLY', False),
+    ('YEAR', False),
+    ('', False),
+])
+def test_is_valid(frequency, valid):
+    assert recurrence.is_valid(frequency) is valid
+
+
+@pytest.mark.parametrize('frequency, expected', [
+    ('WEEKENDS', 'Weekends'),
+    ('FREQ=DAILY;INTERVAL=3', 'Every 3 d.'),
+    ('FREQ=WEEKLY;BYDAY=MO,FR', 'Every w.: Mo,Fr'),
+    ('FREQ=MONTHLY;BYDAY=-1FR', 'Every m.: -1 Fr'),
+    ('FREQ=MONTHLY;BYMONTHDAY=15', 'Every m.: 15'),
+])
+def test_describe(frequency, expected):
+    assert recurrence.describe(frequency, 'ENG') == expected
+
+
+def test_rules_follow_the_local_time():
+    # monday 21:00 UTC is tuesday 00:00 in UTC+3
+    frequency = 'FREQ=WEEKLY;BYDAY=TU'
+    assert db.Reminder.get_next_datetime(D(2026, 10, 12, 21), frequency, timezone='Etc/GMT-3') == \
+        D(2026, 10, 19, 21)
+
+
+@pytest.mark.parametrize('start, frequency, expected', [
+    # saturday 01:00 in UTC+5 is friday 20:00 UTC
+    (D(2026, 10, 16, 20), 'WEEKENDS', [D(2026, 10, 17, 20), D(2026, 10, 23, 20), D(2026, 10, 24, 20)]),
+    (D(2026, 10, 16, 20), 'WORKDAYS', [D(2026, 10, 18, 20), D(2026, 10, 19, 20), D(2026, 10, 20, 20)]),
+    # the 31st at 01:00 in UTC+5 is the 30th UTC, months without it are clamped locally
+    (D(2026, 12, 30, 20), 'MONTH', [D(2027, 1, 30, 20), D(2027, 2, 27, 20), D(2027, 3, 27, 20)]),
+])
+def test_fixed_schedules_follow_the_local_time(start, frequency, expected):
+    occurrences = db.Reminder.get_occurrences(start, frequency, timezone='Etc/GMT-5')
+    assert list(itertools.islice(occurrences, 3)) == expected
+
+
+def add_reminder(engine, when, frequency):
+    session = db.get_session(engine)
+    reminder = db.Reminder(1, 'tea', when, frequency)
+    session.add(reminder)
+    session.flush()
+    reminder_id = reminder.id
+    db.session_commit(session)
+
+    return reminder_id
+
+
+def test_ended_rule_removes_the_reminder(engine):
+    due = datetime.datetime.utcnow().replace(microsecond=0) - datetime.timedelta(minutes=1)
+    ended = add_reminder(engine, due, f'FREQ=DAILY;UNTIL={due:%Y%m%dT%H%M%S}')
+    running = add_reminder(engine, due, 'FREQ=DAILY;INTERVAL=2')
+
+    assert db.Delivery.stage_due_reminders(engine) == 2
+
+    assert db.Reminder.get_reminder(engine, ended) is None
+    assert db.Reminder.get_reminder(engine, running).datetime == due + datetime.timedelta(days=2)
+    assert len(db.Delivery.claim_pending(engine, 'worker')) == 2
+
+
+def test_postponed_ended_rule_removes_the_reminder(engine):
+    when = D(2026, 10, 14, 9)
+    reminder_id = add_reminder(engine, when, f'FREQ=DAILY;UNTIL={when:%Y%m%dT%H%M%S}')
+
+    db.Reminder.move_reccuring_reminder(engine, reminder_id)
+
+    assert db.Reminder.get_reminder(engine, reminder_id) is None
@@ -0,0 +1,128 @@
+import datetime
+
+import pytest
+from telegram.error import NetworkError
+
+from telegramreminder import db
+from telegramreminder.scheduler import ReminderScheduler
+
+
+class FailingBot:
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, **kwargs):
+        self.sent += 1
+        raise NetworkError('no connection')
+
+
+@pytest.fixture
+def scheduler(engine, job_queue):
+    calls = []
+
+    def callback(bot, job):
+        calls.append(job)
+        return False
+
+    scheduler = ReminderScheduler(engine, job_queue, callback, resync_interval=300)
+    scheduler.calls = calls
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+
+
+def after(seconds):
+    return datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
+
+
+def test_idle_scheduler_wakes_for_the_resync(scheduler, job_queue):
+    assert job_queue.job.delay == pytest.approx(300, abs=5)
+
+
+def test_earliest_retry_wakes_the_scheduler(scheduler, job_queue):
+    scheduler.wake_at(after(60))
+    scheduler.wake_at(after(30))
+    scheduler.wake_at(after(90))
+
+    assert job_queue.job.delay == pytest.approx(30, abs=5)
+
+
+def test_due_retry_runs_the_callback(scheduler, job_queue):
+    scheduler.wake_at(after(-1))
+    job_queue.run()
+
+    assert len(scheduler.calls) == 1
+    assert job_queue.job.delay == pytest.approx(300, abs=5)
+
+
+def test_early_wake_does_not_run_the_callback(scheduler, job_queue):
+    scheduler.wake_at(after(30))
+    job_queue.run()
+
+    assert scheduler.calls == []
+    assert job_queue.job.delay == pytest.approx(30, abs=5)
+
+
+def test_failed_callback_is_retried(engine, job_queue):
+    def callback(bot, job):
+        raise RuntimeError('database is gone')
+
+    scheduler = ReminderScheduler(engine, job_queue, callback, error_delay=5)
+    scheduler.start()
+    scheduler.wake_at(after(-1))
+    with pytest.raises(RuntimeError):
+        job_queue.run()
+    scheduler.stop()
+
+    assert job_queue.jobs[-1].delay == pytest.approx(5, abs=1)
+
+
+def add_due_reminder(engine, chat_id):
+    due = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+    session = db.get_session(engine)
+    session.add(db.Reminder(chat_id, 'tea', due, None))
+    db.session_commit(session)
+
+
+def set_next_attempt(engine, chat_id, when):
+    session = db.get_session(engine)
+    session.query(db.Delivery).filter(db.Delivery.chat_id == chat_id).update(
+        {'next_attempt': when})
+    db.session_commit(session)
+
+
+def test_failed_delivery_wakes_the_scheduler(reminder_bot, job_queue):
+    bot = FailingBot()
+    add_due_reminder(reminder_bot.db_engine, 1)
+    add_due_reminder(reminder_bot.db_engine, 2)
+    reminder_bot.reminder_scheduler.wake_at(after(-1))
+
+    job_queue.run(bot)
+    assert bot.sent == 2
+    assert job_queue.job.delay == pytest.approx(30, abs=5)
+
+    # the later retry is not lost when the earlier one is sent
+    set_next_attempt(reminder_bot.db_engine, 1, after(-1))
+    set_next_attempt(reminder_bot.db_engine, 2, after(90))
+    reminder_bot.reminder_scheduler.wake_at(after(-1))
+    job_queue.run(bot)
+    assert bot.sent == 3
+    assert job_queue.job.delay == pytest.approx(60, abs=5)
+
+    set_next_attempt(reminder_bot.db_engine, 1, after(200))
+    reminder_bot.reminder_scheduler.wake_at(after(-1))
+    job_queue.run(bot)
+    assert bot.sent == 3
+    assert job_queue.job.delay == pytest.approx(90, abs=5)
+
+
+def test_lease_of_a_stopped_worker_wakes_the_scheduler(reminder_bot, job_queue):
+    add_due_reminder(reminder_bot.db_engine, 1)
+    db.Delivery.stage_due_reminders(reminder_bot.db_engine)
+    db.Delivery.claim_pending(reminder_bot.db_engine, 'stopped', lease=120)
+
+    reminder_bot.reminder_scheduler.wake_at(after(-1))
+    job_queue.run(FailingBot())
+
+    assert job_queue.job.delay == pytest.approx(120, abs=5)
@@ -0,0 +1,91 @@
+import datetime
+
+import pytest
+
+from telegramreminder import textparser
+
+
+# a wednesday
+NOW = datetime.datetime(2026, 10, 14, 8, 0)
+
+
+@pytest.mark.parametrize('text, date, frequency, title', [
+    ('tea at 9', datetime.datetime(2026, 10, 14, 9, 0), None, 'tea'),
+    ('tea at 9:30', datetime.datetime(2026, 10, 14, 9, 30), None, 'tea'),
+    ('tea at 9 30', datetime.datetime(2026, 10, 14, 9, 30), None, 'tea'),
+    ('tea tomorrow at 9', datetime.datetime(2026, 10, 15, 9, 0), None, 'tea'),
+    ('tea on friday at 9', datetime.datetime(2026, 10, 16, 9, 0), None, 'tea'),
+    ('tea 20 at 9', datetime.datetime(2026, 10, 20, 9, 0), None, 'tea'),
+    ('tea 3 march at 9', datetime.datetime(2027, 3, 3, 9, 0), None, 'tea'),
+    ('tea dec 3 at 9', datetime.datetime(2026, 12, 3, 9, 0), None, 'tea'),
+    ('Call Mom at 18:15 weekly', datetime.datetime(2026, 10, 14, 18, 15), 'WEEK', 'Call Mom'),
+    ('tea at 9 every 3 days', datetime.datetime(2026, 10, 14, 9, 0), 'FREQ=DAILY;INTERVAL=3', 'tea'),
+    ('tea at 9 every day', datetime.datetime(2026, 10, 14, 9, 0), 'DAY', 'tea'),
+    ('tea at 9 every monday', datetime.datetime(2026, 10, 19, 9, 0), 'FREQ=WEEKLY;BYDAY=MO', 'tea'),
+    ('tea at 9 every mon,fri', datetime.datetime(2026, 10, 16, 9, 0), 'FREQ=WEEKLY;BYDAY=MO,FR', 'tea'),
+    ('tea at 9 every sat,sun', datetime.datetime(2026, 10, 17, 9, 0), 'WEEKENDS', 'tea'),
+    ('tea at 9 every last friday', datetime.datetime(2026, 10, 30, 9, 0), 'FREQ=MONTHLY;BYDAY=-1FR', 'tea'),
+    ('tea at 9 every 2nd tue', datetime.datetime(2026, 11, 10, 9, 0), 'FREQ=MONTHLY;BYDAY=2TU', 'tea'),
+])
+def test_parse_english(text, date, frequency, title):
+    assert textparser.parse_reminder(text, NOW, ['ENG']) == (date, frequency, title, None)
+
+
+@pytest.mark.parametrize('text, date, frequency, title', [
+    ('чай в 9', datetime.datetime(2026, 10, 14, 9, 0), None, 'чай'),
+    ('чай послезавтра в 9:30', datetime.datetime(2026, 10, 16, 9, 30), None, 'чай'),
+    ('чай во вторник в 9', datetime.datetime(2026, 10, 20, 9, 0), None, 'чай'),
+    ('чай 5 января в 9', datetime.datetime(2027, 1, 5, 9, 0), None, 'чай'),
+    ('Купить хлеб завтра в 10 30 ежедневно', datetime.datetime(2026, 10, 15, 10, 30), 'DAY', 'Купить хлеб'),
+    ('чай в 9 каждые 2 недели', datetime.datetime(2026, 10, 14, 9, 0), 'FREQ=WEEKLY;INTERVAL=2', 'чай'),
+    ('чай в 9 каждую пятницу', datetime.datetime(2026, 10, 16, 9, 0), 'FREQ=WEEKLY;BYDAY=FR', 'чай'),
+    ('чай в 9 каждый второй вторник', datetime.datetime(2026, 11, 10, 9, 0), 'FREQ=MONTHLY;BYDAY=2TU', 'чай'),
+])
+def test_parse_russian(text, date, frequency, title):
+    assert textparser.parse_reminder(text, NOW, ['RUS']) == (date, frequency, title, None)
+
+
+@pytest.mark.parametrize('language, text, error', [
+    ('ENG', 'tea', textparser.NO_TIME),
+    ('ENG', 'tea at 25', textparser.BAD_TIME),
+    ('ENG', 'tea at 9:75', textparser.BAD_TIME),
+    ('ENG', 'tea at nine', textparser.BAD_TIME),
+    ('ENG', 'tea 32 at 9', textparser.BAD_DATE),
+    ('ENG', 'tea feb 30 at 9', textparser.BAD_DATE),
+    ('ENG', 'at 9', textparser.NO_TEXT),
+    ('ENG', 'tomorrow at 9 daily', textparser.NO_TEXT),
+    ('RUS', 'чай', textparser.NO_TIME),
+    ('RUS', 'чай в 24', textparser.BAD_TIME),
+    ('RUS', 'чай 31 ноября в 9', textparser.BAD_DATE),
+    ('RUS', 'завтра в 9', textparser.NO_TEXT),
+])
+def test_parse_errors(language, text, error):
+    assert textparser.parse_reminder(text, NOW, [language]).error == error
+
+
+@pytest.mark.parametrize('language, text', [
+    ('ENG', 'tea tomorrow at 9'),
+    ('RUS', 'чай завтра в 9'),
+])
+def test_only_datetime_rejects_extra_text(language, text):
+    result = textparser.parse_reminder(text, NOW, [language], only_datetime=True)
+    assert result.error == textparser.EXTRA_TEXT
+
+
+def test_only_datetime():
+    result = textparser.parse_reminder('tomorrow at 9', NOW, ['ENG'], only_datetime=True)
+    assert result == (datetime.datetime(2026, 10, 15, 9, 0), None, '', None)
+
+
+def test_every_in_the_title_is_not_a_frequency():
+    result = textparser.parse_reminder('every day counts at 9', NOW, ['ENG'])
+    assert result == (datetime.datetime(2026, 10, 14, 9, 0), None, 'every day counts', None)
+
+
+def test_other_vocabularies_are_tried():
+    result = textparser.parse_reminder('чай завтра в 9', NOW, ['ENG', 'RUS'])
+    assert result == (datetime.datetime(2026, 10, 15, 9, 0), None, 'чай', None)
+
+
+def test_first_error_other_than_no_time_is_reported():
+    assert textparser.parse_reminder('tea at 25', NOW, ['RUS', 'ENG']).error == textparser.BAD_TIME